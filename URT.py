@@ -4,15 +4,26 @@ from datetime import datetime
 import shutil
 import logging
 import yaml
-from utils.utils import run_subprocess, compress, decompress, compute_checksum, exists_credentials_file, create_credentials_file
+from utils.utils import run_subprocess, compress, decompress, move_folder, compute_checksum, exists_credentials_file, create_credentials_file
 from utils import Modules
+from utils.manifest import ChecksumManifest
+from utils.state import StateStore
+from utils.archive import CODECS, StreamingArchive
+from utils.metrics import MetricsRecorder
+from utils.plan import ORDERS, create_plan, write_plan, read_plan
+from utils.scheduler import StagedScheduler
+from utils.bids import list_subjects, merge_bids_folder, bids_label, compute_source_fingerprint
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import importlib
 import copy
+import math
 
 version="2.0.4"
 
 class URT:
-    def __init__(self, credentials_file="config/credentials.yaml", root_dir="", temp_dir="", logger=None, cache_dir=None, compress=None, bids=None, dataset_name=None) -> None:
+    bids_shard_size = 20 # maximum number of subjects per bidscoiner process: smaller shards lose less work when the conversion is interrupted
+
+    def __init__(self, credentials_file="config/credentials.yaml", root_dir="", temp_dir="", logger=None, cache_dir=None, compress=None, bids=None, dataset_name=None, concurrency=1, verify_workers=None, deep_verify=False, bids_workers=1, codec="gzip", compression_level=None, compression_threads=None, metrics=None, sync=False, download_workers=1) -> None:
         self.logger = logger
         self.root_dir = root_dir
         self.PATH_TO_URT_FOLDER = os.path.dirname(os.path.realpath(__file__))
@@ -20,6 +31,18 @@ class URT:
         self.cache_dir = cache_dir
         self.compress = compress
         self.bids = bids
+        self.concurrency = concurrency
+        self.verify_workers = verify_workers
+        self.deep_verify = deep_verify
+        self.bids_workers = bids_workers
+        self.codec = codec
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        self.archive_extension = CODECS[codec][1]
+        self.metrics = metrics if metrics is not None else MetricsRecorder()
+        self.sync = sync
+        self.download_workers = download_workers
+        self.archive = None # StreamingArchive of the dataset, opened by the first stage which writes files to it
 
         self.dataset_name = dataset_name
 
@@ -29,7 +52,7 @@ class URT:
 
         self.dataset_output_name = self.dataset_folder
         if compress:
-            self.dataset_output_name += ".tar.gz"
+            self.dataset_output_name += self.archive_extension
         
 
         self.temp_collection_dir = os.path.join(temp_dir, self.dataset_folder)
@@ -46,6 +69,8 @@ class URT:
 
         self.file_hashes_path = os.path.join(self.root_dir, ".file_hashes.yaml")
         if not os.path.isabs(self.file_hashes_path): self.file_hashes_path = os.path.join(self.PATH_TO_URT_FOLDER, self.file_hashes_path)
+        self.file_manifest_path = os.path.join(os.path.dirname(self.file_hashes_path), ".file_manifest.sqlite")
+        self.state_path = os.path.join(os.path.dirname(self.file_hashes_path), ".urt_state.sqlite")
 
         self.credentials_file = credentials_file
         if not os.path.isabs(self.credentials_file): self.credentials_file = os.path.join(self.PATH_TO_URT_FOLDER, self.credentials_file)
@@ -59,11 +84,10 @@ class URT:
     # The input is checked for errors in advance in order to minimize user confusion in cases where datasets cannot be downloaded
     def instantiate(self):
         
-        # Open relevant files
-        if not os.path.isfile(self.file_hashes_path):
-            self.logger.debug(f"\"{self.file_hashes_path}\" does not yet exists: creating file.")
-            with open(self.file_hashes_path, "w") as f:
-                yaml.safe_dump({"placeholder":"placeholder"}, f)
+        # Open relevant files: checksums from an existing .file_hashes.yaml are migrated to the state store
+        self.state = StateStore(self.state_path, legacy_yaml_path=self.file_hashes_path, logger=self.logger)
+        # Cache for the hashes of single files: avoids re-reading unchanged datasets when computing their checksums
+        self.manifest = ChecksumManifest(self.file_manifest_path, workers=self.verify_workers)
 
         self.logger.info(f"Loading credentials from \"{self.credentials_file}\"")
         try:
@@ -96,101 +120,180 @@ class URT:
         module = importlib.import_module(f"downloader.{self.downloader}")
 
         downloader_obj = getattr(module, self.downloader)
-        self.downloader_instance = downloader_obj(credentials=self.credentials, logger=self.logger, dataset=self.dataset_name, temp_dir=self.temp_dir, cache_dir=self.cache_dir, datasets=self.datasets_file)
+        self.downloader_instance = downloader_obj(credentials=self.credentials, logger=self.logger, dataset=self.dataset_name, temp_dir=self.temp_dir, cache_dir=self.cache_dir, datasets=self.datasets_file, concurrency=self.concurrency, verify_workers=self.verify_workers, deep_verify=self.deep_verify, metrics=self.metrics, download_workers=self.download_workers)
         return
     
 
     def run(self):
+        if not self.download(): return
+        self.convert()
+        self.finalize()
+        return True
+
+    # The stages of run() are separate methods so that the stages of several datasets can overlap (see StagedScheduler in main)
+    def download(self):
+        '''
+        Returns False if the dataset does not need to be processed any further
+        '''
+        # Only new or changed series are added to an existing dataset
+        if self.sync and os.path.isdir(self.dataset_output_name_path):
+            if self.compress or self.bids or not hasattr(self.downloader_instance, "sync_output_dir"):
+                self.logger.warning(f"Synchronization is only supported for uncompressed datasets without BIDS conversion downloaded from TCIA. Processing {self.dataset_name} as usual.")
+            else:
+                self.logger.info(f"Synchronizing {self.dataset_output_name_path} with the collection {self.dataset_name}")
+                # The dataset is changed, its checksum is computed again after the synchronization
+                self.remove_checksum(self.dataset_output_name)
+                self.downloader_instance.sync_output_dir = self.dataset_output_name_path
+                self.run_downloader()
+                return True
+
         # Check if data already exists
         # TODO check for bugs
         if self.check_path_hash(self.dataset_output_name_path, self.dataset_output_name): 
             self.logger.info(f"Dataset {self.dataset_output_name} already existing in the output folder")
-            return
+            return False
 
         # Check if data only needs to be compressed or decompressed
         # TODO check for bugs
         self.logger.debug(f"Checking for existing compressed/uncompressed data")
-        if self.check_for_existing_uncompressed_or_compressed_data(): return
+        if self.check_for_existing_uncompressed_or_compressed_data(): return False
         
-        # TODO check rare cases, e.g. dataset downloaded but not yet converted and URT tool with the same dataset and --bids option is started
-        # current behavior: re-download dataset and convert it
+        # A dataset which was downloaded but not (completely) converted is not transferred again: the TCIA, Synapse and S3 downloaders skip
+        # the data which is already in the temporary directory (Aspera downloads it again) and convert_to_bids reuses the bidsmap of unchanged
+        # source data and only converts the subjects which are missing in the BIDS folder
 
-        # Download the data
-        self.downloader_instance.run()
-        
-        # Converts data to the bids format (if bids argument is given and data is in dicom or unordered nifti format)
-        self.convert_to_bids()
+        # A dataset which was already converted does not need to be downloaded again (e.g. if URT was interrupted during compression)
+        if self.is_converted():
+            self.logger.info(f"Found converted dataset {self.dataset_folder} in the temporary directory: skipping download")
+            return True
+
+        # Verified series are written to the archive during the download (TCIA only, the BIDS conversion needs the downloaded files)
+        if self.streams_archive() and not self.bids and hasattr(self.downloader_instance, "archive"):
+            self.downloader_instance.archive = self.open_archive()
 
-        # if "keep_patients" is defined: remove unwanted patients
-        self.execute_modules()
+        # Download the data
+        try:
+            self.run_downloader()
+        except BaseException:
+            self.abort_archive()
+            raise
+        return True
 
+    def run_downloader(self):
+        self.state.set_stage(self.dataset_name, "download", "started")
+        with self.metrics.stage(self.dataset_name, "download", path=os.path.join(self.temp_dir, self.dataset_name), counters=self.downloader_instance.request_counters):
+            self.downloader_instance.run()
+        self.state.set_stage(self.dataset_name, "download", "finished")
+    
+    def convert(self):
+        try:
+            # Converts data to the bids format (if bids argument is given and data is in dicom or unordered nifti format)
+            if self.bids:
+                if self.is_converted():
+                    self.logger.info(f"Dataset {self.dataset_folder} is already converted")
+                else:
+                    self.state.set_stage(self.dataset_name, "conversion", "started")
+                    self.convert_to_bids()
+                    self.state.set_stage(self.dataset_name, "conversion", "finished")
+
+            # if "keep_patients" is defined: remove unwanted patients
+            with self.metrics.stage(self.dataset_name, "modules"):
+                self.execute_modules()
+        except BaseException:
+            self.abort_archive()
+            raise
+    
+    def is_converted(self):
+        # Files of an unfinished compression are missing in the converted dataset (they were removed after they were written to the archive)
+        return self.bids and self.state.get_stage(self.dataset_name, "conversion") == "finished" and self.state.get_stage(self.dataset_name, "compression") != "started" and os.path.isdir(self.temp_collection_dir)
+
+    def streams_archive(self):
+        '''
+        Files can be written to the archive (and removed) before the finalization if no module changes them afterwards
+        '''
+        modules = (self.datasets_file.get(self.dataset_name) or {}).get("modules") or []
+        return self.compress and all(module["name"] in Modules.add_only_modules for module in modules)
+
+    def open_archive(self):
+        if self.archive is None:
+            # Files in the archive are removed from the temporary directory, thus the data in the temporary directory is incomplete until the archive is finished
+            self.state.set_stage(self.dataset_name, "compression", "started")
+            self.archive = StreamingArchive(self.dataset_output_name_path, codec=self.codec, level=self.compression_level, threads=self.compression_threads, logger=self.logger)
+        return self.archive
+
+    def abort_archive(self):
+        if self.archive is not None:
+            self.archive.abort()
+            self.archive = None
+    
+    def finalize(self):
         # compress
         
         if self.compress:
-            self.logger.info("Compressing data")
-            compress(output_file=self.dataset_output_name_path, path=self.temp_dir, input_directory=self.dataset_folder, logger=self.logger)
+            self.logger.info(f"Compressing {self.dataset_name}")
+            with self.metrics.stage(self.dataset_name, "compress", path=self.dataset_output_name_path):
+                # The archive may already contain the series or subjects written during the download or conversion, the remaining files are added now
+                archive = self.open_archive()
+                try:
+                    dataset_temp_dir = os.path.join(self.temp_dir, self.dataset_folder)
+                    if os.path.exists(dataset_temp_dir):
+                        archive.add(dataset_temp_dir, arcname=self.dataset_folder, remove=True)
+                    archive_checksum = archive.close()
+                except BaseException:
+                    self.abort_archive()
+                    raise
+                self.archive = None
+            self.state.set_stage(self.dataset_name, "compression", "finished")
         else:
             if self.temp_dir != self.root_dir:
-                self.logger.info(f"Moving data to output directory {self.root_dir}")
-                temp_folder = os.path.join(self.temp_dir, self.dataset_folder)
-                shutil.copytree(temp_folder, self.dataset_output_name_path, dirs_exist_ok=True)
-                shutil.rmtree(temp_folder)
-        self.logger.info("Done")
-
-        # Add checksum for finished dataset
-        self.add_checksum(self.dataset_output_name_path, self.dataset_output_name)
-
-        return True
+                self.logger.info(f"Moving {self.dataset_name} to output directory {self.root_dir}")
+                with self.metrics.stage(self.dataset_name, "move", path=self.dataset_output_name_path):
+                    move_folder(os.path.join(self.temp_dir, self.dataset_folder), self.dataset_output_name_path, logger=self.logger)
+        self.logger.info(f"Done: {self.dataset_name}")
+
+        # Add checksum for finished dataset, the checksum of an archive was already computed while it was written
+        with self.metrics.stage(self.dataset_name, "checksum", path=self.dataset_output_name_path):
+            self.add_checksum(self.dataset_output_name_path, self.dataset_output_name, checksum=archive_checksum if self.compress else None)
+        self.downloader_instance.finished()
     
-    def add_checksum(self, path, name):
-        with open(self.file_hashes_path, "r") as f:
-            file_hashes = yaml.safe_load(f)
-
-        checksum = compute_checksum(path)
-        file_hashes[name] = checksum
-        self.logger.debug(f"Added checksum {checksum} for dataset \"{name}\" to checksum file.")
-
-        with open(self.file_hashes_path, "w") as f:
-            yaml.safe_dump(file_hashes, f)
+    def add_checksum(self, path, name, checksum=None):
+        if checksum is None:
+            checksum = compute_checksum(path, manifest=self.manifest, deep_verify=self.deep_verify)
+        else:
+            # Later verifications of the unchanged file use the cached hash
+            self.manifest.add_file_hashes({path: checksum})
+        self.state.set_checksum(name, checksum)
+        self.logger.debug(f"Added checksum {checksum} for dataset \"{name}\" to the state store.")
 
         return checksum
     
     def remove_checksum(self, name):
-        with open(self.file_hashes_path, "r") as f:
-            file_hashes = yaml.safe_load(f)
-
-        if name in file_hashes:
-            
-            checksum = file_hashes.pop(name)
-            self.logger.debug(f"Removed checksum {checksum} for dataset \"{self.dataset_name}\" file.")
-            with open(self.file_hashes_path, "w") as f:
-                yaml.safe_dump(file_hashes, f)
+        checksum = self.state.remove_checksum(name)
+        if checksum is not None:
+            self.logger.debug(f"Removed checksum {checksum} for dataset \"{self.dataset_name}\" from the state store.")
 
 
     # TODO commentary+logging
     def check_for_existing_uncompressed_or_compressed_data(self):
-        with open(self.file_hashes_path, "r") as f:
-            file_hashes = yaml.safe_load(f)
-
         # If target is compressed data and uncompressed data exists
         if self.compress:
             target_path = self.dataset_output_folder_path
             target_name = self.dataset_folder
             self.logger.debug(f"Checking if uncompressed dataset {target_name} is locally available")
 
-            if target_name in file_hashes:
+            if self.state.get_checksum(target_name) is not None:
                 if self.check_path_hash(target_path, target_name):
                     self.logger.info(f"Dataset {target_name} already existing in the output folder in uncompressed format. Compressing ...")
-                    compress(output_file=self.dataset_output_name_path, path=self.root_dir, input_directory=target_name, logger=self.logger, remove_files=False)
-                    self.add_checksum(self.dataset_output_name_path, self.dataset_output_name)
+                    archive_checksum = compress(output_file=self.dataset_output_name_path, path=self.root_dir, input_directory=target_name, logger=self.logger, remove_files=False, codec=self.codec, level=self.compression_level, threads=self.compression_threads)
+                    self.add_checksum(self.dataset_output_name_path, self.dataset_output_name, checksum=archive_checksum)
                     return True
         # If target is uncompressed data and compressed data exists
         else:
-            target_path = self.dataset_output_name_path + ".tar.gz"
-            target_name = self.dataset_output_name + ".tar.gz"
+            target_path = self.dataset_output_name_path + self.archive_extension
+            target_name = self.dataset_output_name + self.archive_extension
             self.logger.debug(f"Checking if compressed dataset {target_name} is locally available")
 
-            if target_name in file_hashes:
+            if self.state.get_checksum(target_name) is not None:
                 if self.check_path_hash(target_path, target_name):
                     self.logger.info(f"Dataset {target_name} already existing in the output folder in compressed format. Decompressing ...")
                     decompress(input_file=target_path, output_directory=self.root_dir, logger=self.logger)                
@@ -201,18 +304,16 @@ class URT:
 
     
     def check_path_hash(self, path, name):
-        with open(self.file_hashes_path, "r") as f:
-            file_hashes = yaml.safe_load(f)
+        real_hash = self.state.get_checksum(name)
 
-        if name in file_hashes:
+        if real_hash is not None:
             # If folder does not exists return False (means: not downloaded) and remove the checksum for this dataset from the checksum file
             if not os.path.isdir(path) and not os.path.isfile(path):
                 self.logger.debug(f"Path is not a file or directory: {path}")
                 self.remove_checksum(name)
                 return False
         
-            real_hash = file_hashes[name]
-            computed_hash = compute_checksum(path)
+            computed_hash = compute_checksum(path, manifest=self.manifest, deep_verify=self.deep_verify)
 
             if computed_hash == real_hash:
                 self.logger.debug(f"Checksum of local folder {path} is equivalent to checksum of {name}")
@@ -249,21 +350,78 @@ class URT:
                 subject_prefix = self.datasets_file[self.dataset_name]["bids"]["subject-prefix"]
                 
                 plugin = "dcm2niix2bids" if format=="dicom" else "nibabel2bids"
-
-                # Use bidsmapper
-                self.logger.info("Starting bidsmapper")
-                command = f"bidsmapper -f -a -n \"{subject_prefix}\" -m \"{session_prefix}\" \"{dataset_temp_dir}\" \"{dataset_temp_dir_bids}\" -t \"{self.bidsmap_path}\" -p \"{plugin}\""
-                run_subprocess(command, logger=self.logger)
-
-                # Use bidscoiner
-                self.logger.info("Starting bidscoiner")
-                command = f"bidscoiner -f \"{dataset_temp_dir}\" \"{dataset_temp_dir_bids}\""
-                run_subprocess(command, logger=self.logger)
+                subjects = list_subjects(dataset_temp_dir, subject_prefix)
+
+                # Use bidsmapper: the bidsmap of an interrupted conversion is reused if the source data did not change
+                bidsmap_dir = os.path.join(dataset_temp_dir_bids, "code", "bidscoin")
+                fingerprint_path = os.path.join(bidsmap_dir, ".urt_source_fingerprint")
+                fingerprint = compute_source_fingerprint(dataset_temp_dir, subjects)
+                reuse_bidsmap = False
+                if os.path.isfile(os.path.join(bidsmap_dir, "bidsmap.yaml")) and os.path.isfile(fingerprint_path):
+                    with open(fingerprint_path, "r") as f:
+                        reuse_bidsmap = f.read() == fingerprint
+                if reuse_bidsmap:
+                    self.logger.info("Source data unchanged since the last bidsmapper run: reusing bidsmap")
+                else:
+                    self.logger.info("Starting bidsmapper")
+                    # Subjects converted with an old bidsmap have to be converted again
+                    self.state.clear_subjects(self.dataset_name)
+                    command = f"bidsmapper -f -a -n \"{subject_prefix}\" -m \"{session_prefix}\" \"{dataset_temp_dir}\" \"{dataset_temp_dir_bids}\" -t \"{self.bidsmap_path}\" -p \"{plugin}\""
+                    with self.metrics.stage(self.dataset_name, "bidsmapper"):
+                        run_subprocess(command, logger=self.logger)
+                    with open(fingerprint_path, "w") as f:
+                        f.write(fingerprint)
+
+                # Use bidscoiner: only subjects which are missing in the BIDS folder are converted
+                converted_subjects = self.state.get_subjects(self.dataset_name, "converted")
+                missing_subjects = [subject for subject in subjects if not (subject in converted_subjects and os.path.isdir(os.path.join(dataset_temp_dir_bids, bids_label(subject, subject_prefix))))]
+                self.logger.info(f"Starting bidscoiner: {len(missing_subjects)} of {len(subjects)} subjects need to be converted")
+                with self.metrics.stage(self.dataset_name, "bidscoiner", path=dataset_temp_dir_bids):
+                    self.run_bidscoiner_sharded(dataset_temp_dir, dataset_temp_dir_bids, missing_subjects, subject_prefix)
 
                 shutil.rmtree(dataset_temp_dir)
+                self.state.clear_subjects(self.dataset_name)
                 self.logger.info("Bids conversion finished")
                 return
     
+    def run_bidscoiner_sharded(self, dataset_temp_dir, dataset_temp_dir_bids, subjects, subject_prefix):
+        '''
+        Splits the subjects into shards which are converted by parallel bidscoiner processes. Every process writes to its own
+        BIDS folder (containing a copy of the bidsmap), the results are merged into dataset_temp_dir_bids as soon as a shard is finished.
+        The subjects of merged shards are marked as converted, thus an interrupted conversion only needs to convert the remaining shards.
+        With compression the subject folders of merged shards are written to the archive right away.
+        '''
+        if len(subjects) == 0:
+            return
+        number_of_shards = min(len(subjects), max(self.bids_workers, math.ceil(len(subjects) / self.bids_shard_size)))
+        shards = [subjects[i::number_of_shards] for i in range(number_of_shards)]
+        self.logger.info(f"Converting {len(subjects)} subjects in {number_of_shards} shards with {self.bids_workers} parallel bidscoiner processes")
+
+        def convert_shard(i):
+            shard_dir = os.path.join(self.temp_dir, f".{self.dataset_name}_BIDS_shard_{i}")
+            if os.path.exists(shard_dir):
+                shutil.rmtree(shard_dir)
+            shutil.copytree(os.path.join(dataset_temp_dir_bids, "code", "bidscoin"), os.path.join(shard_dir, "code", "bidscoin"), ignore=shutil.ignore_patterns("bidscoiner*"))
+            participant_labels = " ".join(f"\"{subject}\"" for subject in shards[i])
+            command = f"bidscoiner -f \"{dataset_temp_dir}\" \"{shard_dir}\" -p {participant_labels}"
+            run_subprocess(command, logger=self.logger)
+            return i, shard_dir
+
+        with ThreadPoolExecutor(max_workers=self.bids_workers) as executor:
+            futures = [executor.submit(convert_shard, i) for i in range(number_of_shards)]
+            for future in as_completed(futures):
+                i, shard_dir = future.result()
+                merge_bids_folder(shard_dir, dataset_temp_dir_bids)
+                shutil.rmtree(shard_dir)
+                self.state.set_subjects(self.dataset_name, shards[i], "converted")
+                self.logger.debug(f"Merged {shard_dir} into {dataset_temp_dir_bids}")
+                if self.streams_archive():
+                    archive = self.open_archive()
+                    for subject in shards[i]:
+                        label = bids_label(subject, subject_prefix)
+                        if os.path.isdir(os.path.join(dataset_temp_dir_bids, label)):
+                            archive.add(os.path.join(dataset_temp_dir_bids, label), arcname=os.path.join(self.dataset_folder, label), remove=True)
+
     def execute_modules(self):        
         if self.dataset_name in self.datasets_file and "modules" in self.datasets_file[self.dataset_name]:
             modules = self.datasets_file[self.dataset_name]["modules"]
@@ -313,13 +471,28 @@ def get_logger(verbosity, log_dir):
 def main():
     # parse arguments
     parser = argparse.ArgumentParser(description='Download data from TCIA')
-    parser.add_argument('--dataset', '-co', type=str, required=True, help='Dataset name, dataset names as list or path to .yaml file')
+    parser.add_argument('--dataset', '-co', type=str, required=False, help='Dataset name, dataset names as list or path to .yaml file')
     parser.add_argument('--output_dir', '-o', type=str, default='output', required=False, help='Output directory')
     parser.add_argument('--cache_dir', '-l', type=str, default=os.path.join(os.path.expanduser("~"), ".cache", "tcia_downloader"), required=False, help='Directory for cached files and logs. Default is ~/.cache/tcia_downloader')
     parser.add_argument('--temp_dir', '-t', type=str, default="temp", required=False, help='Temporary directory for downloading')
     parser.add_argument('--credentials', '-u', type=str, default="config/credentials.yaml", required=False, help='Username for TCIA')
     parser.add_argument('--compress', '-c', action='store_true', default=False, required=False, help='Choose whether to compress the downloaded data.')
     parser.add_argument('--bids', '-b', action='store_true', default=False, required=False, help='Choose whether to convert the downloaded data to BIDS format.')
+    parser.add_argument('--concurrency', '-j', type=int, default=4, required=False, help='Number of parallel downloads per dataset. Can be overridden per dataset with the "concurrency" key in datasets.yaml. Default is 4')
+    parser.add_argument('--verify_workers', type=int, default=None, required=False, help='Number of threads used for verifying the md5 hashes of downloaded files. Default is the number of CPU cores')
+    parser.add_argument('--deep_verify', '--deep-verify', action='store_true', default=False, required=False, help='Re-read all files when checking the checksums of existing datasets instead of relying on the cached hashes of unchanged files.')
+    parser.add_argument('--codec', type=str, default="gzip", choices=list(CODECS), required=False, help='Compression codec used with --compress. Default is gzip')
+    parser.add_argument('--compression_level', type=int, default=None, required=False, help='Compression level used with --compress. Default is the default level of the codec')
+    parser.add_argument('--compression_threads', type=int, default=None, required=False, help='Number of compression threads used with --compress. Default is one thread per CPU core')
+    parser.add_argument('--bids_workers', type=int, default=1, required=False, help='Number of parallel bidscoiner processes per dataset, the subjects are split between the processes. Default is 1')
+    parser.add_argument('--download_workers', type=int, default=1, required=False, help='Number of datasets which are downloaded at the same time. Default is 1')
+    parser.add_argument('--convert_workers', type=int, default=1, required=False, help='Number of datasets which are converted to BIDS at the same time. Default is 1')
+    parser.add_argument('--finalize_workers', type=int, default=1, required=False, help='Number of datasets which are compressed or moved to the output directory at the same time. Default is 1')
+    parser.add_argument('--plan', type=str, default=None, required=False, help='Only estimate the size of the datasets and write the download plan to the given .json file, nothing is downloaded')
+    parser.add_argument('--order', type=str, default="largest", choices=ORDERS, required=False, help='Order of the datasets in the plan: largest or smallest first. Default is largest')
+    parser.add_argument('--from_plan', type=str, default=None, required=False, help='Download the datasets of a plan created with --plan in the planned order (instead of --dataset)')
+    parser.add_argument('--sync', action='store_true', default=False, required=False, help='Add new and changed series of TCIA collections to existing (uncompressed, not BIDS converted) datasets in the output directory instead of skipping them.')
+    parser.add_argument('--prometheus_textfile', type=str, default=None, required=False, help='Prometheus textfile (e.g. in the directory of the textfile collector of the node exporter) for the metrics of the stages. Metrics are always written to "metrics.jsonl" in the log directory')
     parser.add_argument('--verbosity', '-v', type=str, default="INFO", required=False, help="Choose the level of verbosity from [DEBUG, INFO, WARNING, ERROR, CRITICAL]. Default is 'INFO'")
     args = parser.parse_args()
         
@@ -333,15 +506,40 @@ def main():
     os.makedirs(log_dir, exist_ok=True)
     temp_dir = args.output_dir if args.temp_dir == None else args.temp_dir
     bids = args.bids
+    concurrency = args.concurrency
+    verify_workers = args.verify_workers
+    deep_verify = args.deep_verify
+    bids_workers = args.bids_workers
+    codec = args.codec
+    compression_level = args.compression_level
+    compression_threads = args.compression_threads
+    download_workers = args.download_workers
+    convert_workers = args.convert_workers
+    finalize_workers = args.finalize_workers
+    prometheus_textfile = args.prometheus_textfile
+    sync = args.sync
+    plan_file = args.plan
+    order = args.order
+    from_plan = args.from_plan
+
+    if (datasets is None) == (from_plan is None):
+        raise Exception("Either --dataset or --from_plan has to be given.")
 
     if temp_dir == output:
         raise Exception("Temporary directory and output directory cannot be the same")
     
+    if concurrency < 1:
+        raise Exception("Concurrency must be at least 1.")
+
+    if min(bids_workers, download_workers, convert_workers, finalize_workers) < 1:
+        raise Exception("The number of workers per stage must be at least 1.")
+
     if not verbosity in ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]:
         raise Exception("Invalid level of verbosity.")
     
     logger = get_logger(verbosity=verbosity, log_dir=log_dir)
     logger.info(f"URT downloader version {version} ")
+    metrics = MetricsRecorder(os.path.join(log_dir, "metrics.jsonl"), prometheus_path=prometheus_textfile, logger=logger)
 
     if not os.path.exists(output):
         os.makedirs(output)
@@ -350,8 +548,12 @@ def main():
         os.makedirs(temp_dir)
 
 
+    # If a plan is given: the datasets (subsets already resolved) in the planned order
+    if from_plan is not None:
+        dataset_list = read_plan(from_plan)
+        logger.info(f"Loaded plan \"{from_plan}\" with {len(dataset_list)} datasets")
     # If yaml file is given
-    if datasets.endswith(".yaml"):
+    elif datasets.endswith(".yaml"):
         datasets = os.path.join(os.path.dirname(os.path.realpath(__file__)), datasets)
         with open(datasets) as f:
             dataset_list = yaml.safe_load(f)
@@ -384,12 +586,8 @@ def main():
             logger.debug(f"Removing empty string from dataset_list: \"{d}\"")
             datasets_to_remove.append(d)
 
-    # Remove parent-dataset
-    dataset_set = set(dataset_list)
-    for d in datasets_to_remove:
-        if d in dataset_set:
-            dataset_set.remove(d)
-    dataset_list = list(dataset_set)
+    # Remove parent-dataset and duplicates, the order of the datasets is kept
+    dataset_list = [d for d in dict.fromkeys(dataset_list) if d not in datasets_to_remove]
     logger.debug(f"Datasets to download after removal: {dataset_list}")
 
     i = 1
@@ -402,7 +600,7 @@ def main():
         logger.info(f"Initializing dataset no. {i} of {len(dataset_list)}: {dataset}")
         i += 1
         try:
-            downloader = URT(credentials_file=credentials_file, root_dir=output, temp_dir=temp_dir, logger=logger, cache_dir=cache_dir, compress=compress, bids=bids, dataset_name=dataset)
+            downloader = URT(credentials_file=credentials_file, root_dir=output, temp_dir=temp_dir, logger=logger, cache_dir=cache_dir, compress=compress, bids=bids, dataset_name=dataset, concurrency=concurrency, verify_workers=verify_workers, deep_verify=deep_verify, bids_workers=bids_workers, codec=codec, compression_level=compression_level, compression_threads=compression_threads, metrics=metrics, sync=sync, download_workers=download_workers)
             downloader_list.append(downloader)
         except Exception as e:
             logger.exception(f"Dataset \"{dataset}\" cannot be downloaded")
@@ -410,17 +608,34 @@ def main():
             # raise e # only for debugging
 
 
+    if plan_file is not None:
+        logger.info(f"----- Planning -----")
+        plan = create_plan(downloader_list, logger=logger, order=order, failed_datasets=failed_downloads)
+        write_plan(plan, plan_file)
+        logger.info(f"Plan written to \"{plan_file}\". Start the download with --from_plan \"{plan_file}\"")
+        return
+
     logger.info(f"----- Starting Download -----")
-    i = 1
-    for downloader in downloader_list:
-        logger.info(f"Downloading dataset no. {i} of {len(downloader_list)}: {downloader.dataset_name}")
-        i += 1
-        try:
-            downloader.run()
-        except Exception as e:
-            logger.exception(f"An error occurred during download of collections {downloader.dataset_name}")
+    # Stages of different datasets overlap: e.g. the next dataset is downloaded while the previous one is converted or compressed
+    def download(downloader):
+        logger.info(f"Downloading dataset no. {downloader_list.index(downloader) + 1} of {len(downloader_list)}: {downloader.dataset_name}")
+        return downloader.download()
+
+    def convert(downloader):
+        logger.info(f"Post-processing dataset {downloader.dataset_name}")
+        return downloader.convert()
+
+    stages = [
+        ("download", download, download_workers),
+        ("conversion", convert, convert_workers),
+        ("finalization", URT.finalize, finalize_workers),
+    ]
+    scheduler = StagedScheduler(stages, logger=logger, describe=lambda downloader: f"collections {downloader.dataset_name}")
+    results = scheduler.run(downloader_list)
+
+    for downloader, exception in zip(downloader_list, results):
+        if exception is not None:
             failed_downloads.append(downloader.dataset_name)
-            # raise e # only for debugging
         else:
             successful_downloads.append(downloader.dataset_name)
     
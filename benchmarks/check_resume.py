@@ -0,0 +1,122 @@
+'''
+Checks the resumption of interrupted series downloads (TciaAPI.download_file) against the local NBIA stand-in (benchmarks/nbia_server.py):
+- a partial ".part" file is completed with a range request, only the missing bytes are transferred
+- a server without range support answers with 200 and the download starts from the beginning
+- a ".part" file which does not fit the archive on the server (416) is discarded and downloaded again
+- connections dropped by the server are resumed until the archive is complete, without transferring the received data again
+
+Usage (from the root of the repository): python benchmarks/check_resume.py [--verbose]
+Exits with a non-zero exit code if a check fails.
+'''
+import os
+import sys
+import shutil
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from downloader.TciaDownloader import TciaAPI
+from nbia_server import NbiaStandIn
+
+def download(stand_in, directory, SeriesInstanceUID, prefix=None, logger=None):
+    '''
+    Downloads the archive of the series to directory, the ".part" file starts with prefix (e.g. the first half of the archive).
+    Returns the downloaded bytes, the archive on the server and the number of bytes the server sent.
+    '''
+    api = TciaAPI(logger=logger, cache_dir=directory, concurrency=1, api_root=stand_in.url)
+    # No need to wait seconds between the retries of a local server
+    api.governor.base_delay = 0.01
+    file_path = os.path.join(directory, SeriesInstanceUID + ".zip.part")
+    if prefix is not None:
+        with open(file_path, "wb") as f:
+            f.write(prefix)
+    bytes_before = stand_in.counters["bytes"]
+    api.download_file(url=api.base_url + "getImage", file_path=file_path, params={"SeriesInstanceUID": SeriesInstanceUID})
+    with open(file_path, "rb") as f:
+        downloaded = f.read()
+    os.remove(file_path)
+    with open(os.path.join(stand_in.directory, SeriesInstanceUID + ".zip"), "rb") as f:
+        archive = f.read()
+    return downloaded, archive, stand_in.counters["bytes"] - bytes_before
+
+def check_range_resume(directory, logger):
+    stand_in = NbiaStandIn(series=1, images=4, image_size=100*1024)
+    stand_in.start()
+    try:
+        SeriesInstanceUID = next(iter(stand_in.series))
+        with open(os.path.join(stand_in.directory, SeriesInstanceUID + ".zip"), "rb") as f:
+            prefix = f.read()[:150*1024]
+        downloaded, archive, sent = download(stand_in, directory, SeriesInstanceUID, prefix=prefix, logger=logger)
+        assert downloaded == archive, "resumed archive differs from the archive on the server"
+        assert sent == len(archive) - len(prefix), f"server sent {sent} bytes instead of the missing {len(archive) - len(prefix)} bytes"
+    finally:
+        stand_in.stop()
+
+def check_full_restart_without_ranges(directory, logger):
+    stand_in = NbiaStandIn(series=1, images=4, image_size=100*1024, range_requests=False)
+    stand_in.start()
+    try:
+        SeriesInstanceUID = next(iter(stand_in.series))
+        with open(os.path.join(stand_in.directory, SeriesInstanceUID + ".zip"), "rb") as f:
+            prefix = f.read()[:150*1024]
+        downloaded, archive, sent = download(stand_in, directory, SeriesInstanceUID, prefix=prefix, logger=logger)
+        assert downloaded == archive, "archive downloaded after a 200 response differs from the archive on the server"
+        assert sent == len(archive), f"server sent {sent} bytes instead of the whole archive ({len(archive)} bytes)"
+    finally:
+        stand_in.stop()
+
+def check_unsatisfiable_range(directory, logger):
+    stand_in = NbiaStandIn(series=1, images=4, image_size=100*1024)
+    stand_in.start()
+    try:
+        SeriesInstanceUID = next(iter(stand_in.series))
+        size = os.path.getsize(os.path.join(stand_in.directory, SeriesInstanceUID + ".zip"))
+        # Longer than the archive on the server, e.g. left over from an older version of the series
+        downloaded, archive, sent = download(stand_in, directory, SeriesInstanceUID, prefix=os.urandom(size + 1000), logger=logger)
+        assert downloaded == archive, "archive downloaded after a 416 response differs from the archive on the server"
+        assert sent == len(archive), f"server sent {sent} bytes instead of the whole archive ({len(archive)} bytes)"
+    finally:
+        stand_in.stop()
+
+def check_dropped_connections(directory, logger):
+    stand_in = NbiaStandIn(series=10, images=4, image_size=100*1024, drop_rate=0.3, seed=1)
+    stand_in.start()
+    try:
+        total_size = 0
+        for SeriesInstanceUID in stand_in.series:
+            downloaded, archive, sent = download(stand_in, directory, SeriesInstanceUID, logger=logger)
+            assert downloaded == archive, f"archive of {SeriesInstanceUID} differs from the archive on the server after dropped connections"
+            total_size += len(archive)
+        assert stand_in.counters["drops"] > 0, "the stand-in did not drop any connection"
+        # Only the data of the read which was interrupted by the drop is transferred again
+        resent = stand_in.counters["bytes"] - total_size
+        assert resent < stand_in.counters["drops"] * TciaAPI(logger=logger, cache_dir=directory, api_root=stand_in.url).read_size, f"server sent {resent} bytes twice after {stand_in.counters['drops']} dropped connections"
+    finally:
+        stand_in.stop()
+
+CHECKS = [check_range_resume, check_full_restart_without_ranges, check_unsatisfiable_range, check_dropped_connections]
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the resumption of TCIA downloads against a local NBIA stand-in")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    logger = logging.getLogger("check_resume")
+
+    failed = 0
+    for check in CHECKS:
+        directory = tempfile.mkdtemp(prefix="urt_check_resume_")
+        try:
+            check(directory, logger)
+            print(f"OK      {check.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"FAILED  {check.__name__}: {e}")
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+'''
+Checks the S3 download of the AwsDownloader against the local S3 stand-in (benchmarks/s3_server.py):
+- listings spanning several ListObjectsV2 pages are followed to the end and all objects are downloaded
+- objects whose size and ETag match the record of the previous download are skipped, changed objects and modified local files are downloaded again
+- large objects are downloaded in parts with range requests (small multipart_threshold) and moved from their ".part" file when complete
+- an object whose md5 does not match its ETag fails the download and leaves neither the object nor its ".part" file
+- a failed part stops the remaining parts of its object and removes the ".part" file
+
+Usage (from the root of the repository): python benchmarks/check_s3.py [--verbose]
+Exits with a non-zero exit code if a check fails.
+'''
+import os
+import sys
+import shutil
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from downloader.AwsDownloader import AwsDownloader
+from s3_server import S3StandIn, build_objects
+
+DATASET = "ds-check"
+PREFIX = "dataset/"
+
+def create_downloader(stand_in, directory, logger, concurrency=4, multipart_threshold=None, part_size=None):
+    datasets = {DATASET: {"url": f"s3://{stand_in.bucket}/{PREFIX}", "endpoint_url": stand_in.url}}
+    downloader = AwsDownloader(dataset=DATASET, logger=logger, temp_dir=directory, cache_dir=directory, datasets=datasets, concurrency=concurrency)
+    # No need to wait seconds between the retries of a local server
+    downloader.governor.base_delay = 0.01
+    if multipart_threshold is not None:
+        downloader.multipart_threshold = multipart_threshold
+    if part_size is not None:
+        downloader.part_size = part_size
+    return downloader
+
+def local_file(directory, key):
+    return os.path.join(directory, DATASET, key[len(PREFIX):])
+
+def assert_downloaded(stand_in, directory):
+    for key, content in stand_in.objects.items():
+        with open(local_file(directory, key), "rb") as f:
+            assert f.read() == content, f"{key} differs from the object on the server"
+    part_files = [name for _, _, names in os.walk(directory) for name in names if name.endswith(".part")]
+    assert not part_files, f"\".part\" files left after the download: {part_files}"
+
+def check_pagination(directory, logger):
+    stand_in = S3StandIn(objects=build_objects(PREFIX, 23, 1024), page_size=5)
+    stand_in.start()
+    try:
+        create_downloader(stand_in, directory, logger).run()
+        assert stand_in.counters["list_requests"] == 5, f"{stand_in.counters['list_requests']} ListObjectsV2 requests instead of 5 pages"
+        assert stand_in.counters["object_requests"] == 23, f"{stand_in.counters['object_requests']} GET requests for 23 objects"
+        assert_downloaded(stand_in, directory)
+    finally:
+        stand_in.stop()
+
+def check_skip_up_to_date(directory, logger):
+    objects = build_objects(PREFIX, 10, 4096)
+    stand_in = S3StandIn(objects=objects)
+    stand_in.start()
+    try:
+        create_downloader(stand_in, directory, logger).run()
+        stand_in.requested_keys.clear()
+        create_downloader(stand_in, directory, logger).run()
+        assert stand_in.requested_keys == [], f"up to date objects were downloaded again: {stand_in.requested_keys}"
+
+        changed_key, modified_key = sorted(objects)[:2]
+        # Same size, thus only the ETag shows the change
+        stand_in.put_object(changed_key, os.urandom(len(objects[changed_key])))
+        with open(local_file(directory, modified_key), "r+b") as f:
+            f.write(b"modified")
+        create_downloader(stand_in, directory, logger).run()
+        assert sorted(stand_in.requested_keys) == [changed_key, modified_key], f"downloaded {stand_in.requested_keys} instead of the changed object and the modified file"
+        assert_downloaded(stand_in, directory)
+    finally:
+        stand_in.stop()
+
+def check_multipart(directory, logger):
+    objects = build_objects(PREFIX, 4, 1024)
+    objects[PREFIX + "large.bin"] = os.urandom(1024 * 1024 + 123)
+    # Random 503 responses are retried per part
+    stand_in = S3StandIn(objects=objects, failure_rate=0.3, retry_after=0)
+    stand_in.start()
+    try:
+        create_downloader(stand_in, directory, logger, multipart_threshold=256 * 1024, part_size=64 * 1024).run()
+        assert stand_in.counters["range_requests"] == 17, f"{stand_in.counters['range_requests']} range requests instead of 17 parts"
+        assert stand_in.counters["failures"] > 0, "the stand-in did not answer any request with 503"
+        assert_downloaded(stand_in, directory)
+    finally:
+        stand_in.stop()
+
+def check_etag_mismatch(directory, logger):
+    for key, content, multipart_threshold in [(PREFIX + "small.bin", os.urandom(1000), None), (PREFIX + "large.bin", os.urandom(300 * 1024), 256 * 1024)]:
+        stand_in = S3StandIn()
+        stand_in.put_object(key, content, etag="0" * 32)
+        stand_in.start()
+        try:
+            try:
+                create_downloader(stand_in, directory, logger, multipart_threshold=multipart_threshold, part_size=64 * 1024).run()
+                raise AssertionError(f"download of {key} with a wrong ETag did not fail")
+            except AssertionError:
+                raise
+            except Exception as e:
+                assert "does not match its ETag" in str(e), f"unexpected error for {key}: {e}"
+            path = local_file(directory, key)
+            assert not os.path.exists(path), f"{key} was kept although its md5 does not match its ETag"
+            assert not os.path.exists(path + ".part"), f"\".part\" file of {key} was kept after the ETag mismatch"
+        finally:
+            stand_in.stop()
+
+def check_failed_part(directory, logger):
+    key = PREFIX + "large.bin"
+    part_size = 64 * 1024
+    stand_in = S3StandIn(objects={key: os.urandom(10 * part_size)})
+    # The third part is answered with 403, which is not retried
+    stand_in.forbidden_ranges.add((key, 2 * part_size))
+    stand_in.start()
+    try:
+        try:
+            create_downloader(stand_in, directory, logger, concurrency=1, multipart_threshold=256 * 1024, part_size=part_size).run()
+            raise AssertionError("download with a failed part did not fail")
+        except AssertionError:
+            raise
+        except Exception as e:
+            assert "403" in str(e), f"unexpected error: {e}"
+        assert stand_in.counters["range_requests"] == 3, f"{stand_in.counters['range_requests']} range requests, the parts after the failed one were not stopped"
+        assert not os.path.exists(local_file(directory, key) + ".part"), "\".part\" file was kept after a failed part"
+    finally:
+        stand_in.stop()
+
+CHECKS = [check_pagination, check_skip_up_to_date, check_multipart, check_etag_mismatch, check_failed_part]
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the S3 download of the AwsDownloader against a local S3 stand-in")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    logger = logging.getLogger("check_s3")
+
+    failed = 0
+    for check in CHECKS:
+        directory = tempfile.mkdtemp(prefix="urt_check_s3_")
+        try:
+            check(directory, logger)
+            print(f"OK      {check.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"FAILED  {check.__name__}: {e}")
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
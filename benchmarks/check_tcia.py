@@ -0,0 +1,106 @@
+'''
+Checks TciaDownloader end to end against the local NBIA stand-in (benchmarks/nbia_server.py):
+- a collection of which TCIA returns no series (e.g. a restricted collection without credentials) is downloaded as an empty dataset,
+  also when synchronizing with an existing output directory (--sync), and its size is estimated as zero (--plan)
+- all series of a small collection are downloaded
+
+Usage (from the root of the repository): python benchmarks/check_tcia.py [--verbose]
+Exits with a non-zero exit code if a check fails.
+'''
+import os
+import sys
+import shutil
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from downloader.TciaDownloader import TciaDownloader
+from nbia_server import NbiaStandIn
+
+def create_downloader(stand_in, directory, logger):
+    datasets = {stand_in.collection: {"format": "dicom", "downloader": "TciaDownloader", "api_root": stand_in.url}}
+    downloader = TciaDownloader(temp_dir=os.path.join(directory, "temp"), dataset=stand_in.collection, logger=logger, cache_dir=directory, datasets=datasets, concurrency=2)
+    # No need to wait seconds between the retries of a local server
+    downloader.tcia_api.governor.base_delay = 0.01
+    return downloader
+
+def dicom_folders(folder):
+    return [root for root, dirs, files in os.walk(folder) if any(file.endswith(".dcm") for file in files)]
+
+def check_empty_collection(directory, logger):
+    stand_in = NbiaStandIn(series=0)
+    stand_in.start()
+    try:
+        downloader = create_downloader(stand_in, directory, logger)
+        downloader.run()
+        assert len(downloader.series_catalog) == 0, f"catalog of an empty collection contains {len(downloader.series_catalog)} series"
+        assert dicom_folders(downloader.temp_dir) == [], "series folders were created for an empty collection"
+        assert os.path.isfile(os.path.join(downloader.temp_dir, "metadata.csv")), "metadata.csv is missing"
+    finally:
+        stand_in.stop()
+
+def check_empty_collection_sync(directory, logger):
+    stand_in = NbiaStandIn(series=0)
+    stand_in.start()
+    try:
+        downloader = create_downloader(stand_in, directory, logger)
+        downloader.sync_output_dir = os.path.join(directory, "output")
+        os.makedirs(downloader.sync_output_dir)
+        downloader.run()
+        assert len(downloader.seriesDF) == 0, f"{len(downloader.seriesDF)} series selected for the synchronization of an empty collection"
+    finally:
+        stand_in.stop()
+
+def check_empty_collection_estimate(directory, logger):
+    stand_in = NbiaStandIn(series=0)
+    stand_in.start()
+    try:
+        estimate = create_downloader(stand_in, directory, logger).estimate_size()
+        assert estimate == {"bytes": 0, "files": 0, "series": 0}, f"estimated {estimate} for an empty collection"
+    finally:
+        stand_in.stop()
+
+def check_collection(directory, logger):
+    stand_in = NbiaStandIn(series=6, images=3, image_size=16*1024)
+    stand_in.start()
+    try:
+        downloader = create_downloader(stand_in, directory, logger)
+        downloader.run()
+        folders = dicom_folders(downloader.temp_dir)
+        assert len(folders) == 6, f"{len(folders)} series folders instead of 6"
+        for folder in folders:
+            images = [file for file in os.listdir(folder) if file.endswith(".dcm")]
+            assert len(images) == 3, f"{folder} contains {len(images)} images instead of 3"
+    finally:
+        stand_in.stop()
+
+CHECKS = [check_empty_collection, check_empty_collection_sync, check_empty_collection_estimate, check_collection]
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks TciaDownloader end to end against a local NBIA stand-in")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    logger = logging.getLogger("check_tcia")
+
+    failed = 0
+    for check in CHECKS:
+        directory = tempfile.mkdtemp(prefix="urt_check_tcia_")
+        try:
+            check(directory, logger)
+            print(f"OK      {check.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"FAILED  {check.__name__}: {e}")
+        except Exception as e:
+            # Regressions of the downloader show up as exceptions of run
+            failed += 1
+            print(f"FAILED  {check.__name__}: {type(e).__name__}: {e}")
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+'''
+Local stand-in for the NBIA API of TCIA, used by the benchmarks. It serves a synthetic collection with the endpoints used by TciaAPI
+(getCollectionValues, getSeries, getSeriesMetaData, getSOPInstanceUIDs, getImage, getImageWithMD5Hash and the token endpoint).
+The series archives are generated once at startup and served from disk, with optional latency, bandwidth limit, error responses
+and dropped connections. HTTP range requests are supported.
+
+Usage: python benchmarks/nbia_server.py --series 50 --images 20 --image_size 262144 [--latency 0.05] [--failure_rate 0.01] [--drop_rate 0.01]
+The server prints the URL of the API root once it is ready.
+'''
+import os
+import io
+import csv
+import json
+import time
+import random
+import shutil
+import hashlib
+import zipfile
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+def series_uid(collection_index, series_index):
+    return f"1.3.6.1.4.1.9328.50.{collection_index}.{series_index:06d}"
+
+def build_collection(collection, directory, series, images, image_size, patients, seed=0):
+    '''
+    Writes one zip archive per series to directory and returns the series and metadata entries of the collection
+    '''
+    rng = random.Random(seed)
+    series_entries = []
+    metadata_entries = []
+    for i in range(series):
+        SeriesInstanceUID = series_uid(1, i)
+        PatientID = f"{collection}-{i % patients:04d}"
+        StudyInstanceUID = f"1.3.6.1.4.1.9328.50.2.{i % patients:06d}"
+        zip_path = os.path.join(directory, SeriesInstanceUID + ".zip")
+        hashes = []
+        # The archives are flat like the ones of getImage: the files end up directly in the series folder
+        with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED) as zip_file:
+            for j in range(images):
+                # Preamble and DICM prefix like a DICOM file, the content itself is random (thus incompressible)
+                content = bytes(128) + b"DICM" + rng.randbytes(max(0, image_size - 132))
+                SOPInstanceUID = f"{SeriesInstanceUID}.{j}"
+                zip_file.writestr(f"1-{j + 1:04d}.dcm", content)
+                hashes.append((SOPInstanceUID, hashlib.md5(content).hexdigest()))
+            md5_csv = io.StringIO()
+            writer = csv.writer(md5_csv, lineterminator="\n")
+            writer.writerow(["SOPInstanceUID", "MD5Hash"])
+            writer.writerows(hashes)
+            zip_file.writestr("md5hashes.csv", md5_csv.getvalue())
+
+        series_entries.append({
+            "SeriesInstanceUID": SeriesInstanceUID,
+            "StudyInstanceUID": StudyInstanceUID,
+            "Modality": "MR",
+            "ProtocolName": "benchmark",
+            "SeriesDate": f"2001-01-{i % 28 + 1:02d} 00:00:00.0",
+            "SeriesDescription": f"series {i}",
+            "BodyPartExamined": "BRAIN",
+            "SeriesNumber": i + 1,
+            "Collection": collection,
+            "PatientID": PatientID,
+            "Manufacturer": "URT",
+            "ImageCount": images,
+            "FileSize": os.path.getsize(zip_path),
+            "sop_instance_uids": [SOPInstanceUID for SOPInstanceUID, md5 in hashes],
+        })
+        metadata_entries.append({
+            "Collection": collection,
+            "Subject ID": PatientID,
+            "Study UID": StudyInstanceUID,
+            "Study Description": f"study {i % patients}",
+            "Series UID": SeriesInstanceUID,
+            "Modality": "MR",
+            "Series Description": f"series {i}",
+            "Number of images": images,
+            "File Size": os.path.getsize(zip_path),
+        })
+    return series_entries, metadata_entries
+
+
+class NbiaStandIn:
+    def __init__(self, collection="URT-Benchmark", series=20, images=10, image_size=256*1024, patients=5, latency=0.0,
+                 failure_rate=0.0, drop_rate=0.0, bandwidth=None, range_requests=True, seed=0):
+        '''
+        latency: seconds added to every response
+        failure_rate: share of requests answered with 503 and a Retry-After header
+        drop_rate: share of archive downloads whose connection is closed after half of the data
+        bandwidth: bytes per second and connection for archive downloads (None: unlimited)
+        '''
+        self.collection = collection
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.bandwidth = bandwidth
+        self.range_requests = range_requests
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.counter_lock = threading.Lock()
+        self.counters = {"requests": 0, "failures": 0, "drops": 0, "bytes": 0}
+        self.directory = tempfile.mkdtemp(prefix="nbia_stand_in_")
+        series_entries, metadata_entries = build_collection(collection, self.directory, series, images, image_size, patients, seed=seed)
+        self.series = {entry["SeriesInstanceUID"]: entry for entry in series_entries}
+        self.metadata = {entry["Series UID"]: entry for entry in metadata_entries}
+        self.server = None
+
+    def chance(self, rate):
+        with self.random_lock:
+            return self.random.random() < rate
+
+    def count(self, key, value=1):
+        with self.counter_lock:
+            self.counters[key] += value
+
+    def start(self, host="127.0.0.1", port=0):
+        stand_in = self
+        class Handler(NbiaRequestHandler):
+            server_state = stand_in
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/nbia-api/"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class NbiaRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status, headers={}):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def begin_request(self):
+        '''
+        Returns False if the request was answered with an error
+        '''
+        state = self.server_state
+        state.count("requests")
+        if state.latency:
+            time.sleep(state.latency)
+        if state.chance(state.failure_rate):
+            state.count("failures")
+            self.send_empty(503, {"Retry-After": "1"})
+            return False
+        return True
+
+    def do_POST(self):
+        if not self.begin_request():
+            return
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlparse(self.path).path.endswith("/oauth/token"):
+            self.send_json({"access_token": "benchmark-token", "expires_in": 7200, "token_type": "bearer"})
+        else:
+            self.send_empty(404)
+
+    def do_GET(self):
+        if not self.begin_request():
+            return
+        state = self.server_state
+        url = urlparse(self.path)
+        endpoint = url.path.rstrip("/").split("/")[-1]
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        SeriesInstanceUID = params.get("SeriesInstanceUID")
+
+        if endpoint == "getCollectionValues":
+            self.send_json([{"Collection": state.collection}])
+        elif endpoint == "getSeries":
+            if params.get("Collection") != state.collection:
+                self.send_json([])
+            else:
+                self.send_json([{key: value for key, value in entry.items() if key != "sop_instance_uids"} for entry in state.series.values()])
+        elif endpoint == "getSeriesMetaData" and SeriesInstanceUID in state.metadata:
+            self.send_json([state.metadata[SeriesInstanceUID]])
+        elif endpoint == "getSOPInstanceUIDs" and SeriesInstanceUID in state.series:
+            self.send_json([{"SOPInstanceUID": SOPInstanceUID} for SOPInstanceUID in state.series[SeriesInstanceUID]["sop_instance_uids"]])
+        elif endpoint in ["getImage", "getImageWithMD5Hash"] and SeriesInstanceUID in state.series:
+            self.send_archive(os.path.join(state.directory, SeriesInstanceUID + ".zip"))
+        else:
+            self.send_empty(404)
+
+    def send_archive(self, zip_path):
+        state = self.server_state
+        size = os.path.getsize(zip_path)
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header is not None and state.range_requests:
+            start = int(range_header.split("=")[1].split("-")[0])
+            if start >= size:
+                self.send_empty(416, {"Content-Range": f"bytes */{size}"})
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(size - start))
+        self.send_header("Accept-Ranges", "bytes" if state.range_requests else "none")
+        self.end_headers()
+
+        # A dropped connection stops after half of the remaining data
+        end = start + (size - start) // 2 if state.chance(state.drop_rate) else size
+        chunk_size = 64 * 1024
+        with open(zip_path, "rb") as f:
+            f.seek(start)
+            position = start
+            while position < end:
+                chunk = f.read(min(chunk_size, end - position))
+                chunk_start = time.monotonic()
+                self.wfile.write(chunk)
+                position += len(chunk)
+                state.count("bytes", len(chunk))
+                if state.bandwidth:
+                    time.sleep(max(0, len(chunk) / state.bandwidth - (time.monotonic() - chunk_start)))
+        if end < size:
+            state.count("drops")
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the NBIA API of TCIA")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--collection", type=str, default="URT-Benchmark")
+    parser.add_argument("--series", type=int, default=20)
+    parser.add_argument("--images", type=int, default=10, help="Number of images per series")
+    parser.add_argument("--image_size", type=int, default=256*1024, help="Size of a single image in bytes")
+    parser.add_argument("--patients", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--drop_rate", type=float, default=0.0, help="Share of archive downloads which are interrupted")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Bytes per second and connection for archive downloads")
+    parser.add_argument("--no_range_requests", action="store_true", help="Ignore HTTP range requests")
+    args = parser.parse_args()
+
+    stand_in = NbiaStandIn(collection=args.collection, series=args.series, images=args.images, image_size=args.image_size, patients=args.patients,
+                           latency=args.latency, failure_rate=args.failure_rate, drop_rate=args.drop_rate, bandwidth=args.bandwidth,
+                           range_requests=not args.no_range_requests)
+    print(stand_in.start(port=args.port), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stand_in.stop()
@@ -0,0 +1,159 @@
+'''
+Runs TciaDownloader.run end to end against the local NBIA stand-in (benchmarks/nbia_server.py) and writes the results to a JSON file:
+series/s, MB/s, peak memory usage and the time of every stage of the download. The stand-in runs in a separate process, thus the
+peak memory usage is the one of the downloader only.
+
+Usage (from the root of the repository):
+python benchmarks/run_benchmark.py --series 50 --images 20 --concurrency 8 [--latency 0.05] [--failure_rate 0.01] [--drop_rate 0.01] [--output results.json]
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from downloader.TciaDownloader import TciaDownloader
+from utils.utils import peak_memory_usage
+
+# Methods of TciaDownloader which are timed, in the order in which TciaDownloader.run calls them
+STAGES = ["download_series_metadata", "build_series_catalog", "add_paths_to_series", "remove_unkown_instances", "download_series", "rename_patients"]
+
+def start_stand_in(args):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "nbia_server.py"), "--port", "0",
+               "--collection", args.collection, "--series", str(args.series), "--images", str(args.images), "--image_size", str(args.image_size),
+               "--patients", str(args.patients), "--latency", str(args.latency), "--failure_rate", str(args.failure_rate), "--drop_rate", str(args.drop_rate)]
+    if args.bandwidth:
+        command += ["--bandwidth", str(args.bandwidth)]
+    if args.no_range_requests:
+        command.append("--no_range_requests")
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    url = process.stdout.readline().strip()
+    if not url:
+        process.kill()
+        raise Exception("NBIA stand-in did not start")
+    return process, url
+
+def timed(stage_times, name, function):
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stage_times[name] = stage_times.get(name, 0) + time.perf_counter() - start_time
+    return wrapper
+
+def folder_size(folder):
+    total_size, files = 0, 0
+    for root, dirs, file_names in os.walk(folder):
+        for file in file_names:
+            total_size += os.path.getsize(os.path.join(root, file))
+            files += 1
+    return total_size, files
+
+def run_downloader(args, url, temp_dir, cache_dir, logger):
+    datasets = {args.collection: {"format": "dicom", "downloader": "TciaDownloader", "api_root": url}}
+    credentials = {"TCIA": {"user": "benchmark", "password": "benchmark"}} if args.privileged else None
+    stage_times = {}
+
+    start_time = time.perf_counter()
+    downloader = TciaDownloader(credentials=credentials, temp_dir=temp_dir, dataset=args.collection, logger=logger, cache_dir=cache_dir,
+                                datasets=datasets, concurrency=args.concurrency, verify_workers=args.verify_workers)
+    stage_times["setup"] = time.perf_counter() - start_time
+    downloader.tcia_api.getSeriesDF = timed(stage_times, "getSeries", downloader.tcia_api.getSeriesDF)
+    for stage in STAGES:
+        setattr(downloader, stage, timed(stage_times, stage, getattr(downloader, stage)))
+
+    downloader.run()
+    wall_time = time.perf_counter() - start_time
+
+    total_size, files = folder_size(downloader.temp_dir)
+    series = len(downloader.seriesDF)
+    return {
+        "wall_time_s": wall_time,
+        "series": series,
+        "files": files,
+        "bytes": total_size,
+        "series_per_s": series / wall_time,
+        "mb_per_s": total_size / 1024**2 / wall_time,
+        "stage_times_s": stage_times,
+        "governor": {
+            "concurrency": int(downloader.tcia_api.governor.limit),
+            "error_rate": downloader.tcia_api.governor.error_rate(),
+        },
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the TCIA download against a local NBIA stand-in")
+    parser.add_argument("--collection", type=str, default="URT-Benchmark")
+    parser.add_argument("--series", type=int, default=20)
+    parser.add_argument("--images", type=int, default=10, help="Number of images per series")
+    parser.add_argument("--image_size", type=int, default=256*1024, help="Size of a single image in bytes")
+    parser.add_argument("--patients", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response of the stand-in")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--drop_rate", type=float, default=0.0, help="Share of archive downloads which are interrupted")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Bytes per second and connection for archive downloads")
+    parser.add_argument("--no_range_requests", action="store_true", help="Stand-in ignores HTTP range requests")
+    parser.add_argument("--privileged", action="store_true", help="Use credentials, i.e. request a token and use the v2 API")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--verify_workers", type=int, default=None)
+    parser.add_argument("--rerun", action="store_true", help="Run the downloader a second time on the finished download (time for checking an up-to-date dataset)")
+    parser.add_argument("--output", type=str, default=None, help="JSON file for the results. Default is benchmarks/results/<timestamp>.json")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    logger = logging.getLogger("benchmark")
+
+    work_dir = tempfile.mkdtemp(prefix="urt_benchmark_")
+    temp_dir = os.path.join(work_dir, "temp")
+    cache_dir = os.path.join(work_dir, "cache")
+    os.makedirs(temp_dir)
+    os.makedirs(cache_dir)
+
+    process, url = start_stand_in(args)
+    try:
+        results = {"download": run_downloader(args, url, temp_dir, cache_dir, logger)}
+        if args.rerun:
+            results["rerun"] = run_downloader(args, url, temp_dir, cache_dir, logger)
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "timestamp": datetime.now().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "config": vars(args),
+        "peak_memory_mb": peak_memory_usage(),
+        **results,
+    }
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", datetime.now().strftime("%Y%m%d_%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=4)
+
+    download = results["download"]
+    print(f"{download['series']} series, {download['bytes'] / 1024**2:.1f} MB in {download['wall_time_s']:.1f} s: {download['series_per_s']:.2f} series/s, {download['mb_per_s']:.1f} MB/s, peak memory {report['peak_memory_mb']:.1f} MB")
+    for stage, stage_time in download["stage_times_s"].items():
+        print(f"  {stage}: {stage_time:.2f} s")
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
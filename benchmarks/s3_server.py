@@ -0,0 +1,185 @@
+'''
+Local stand-in for the anonymous S3 requests of the AwsDownloader: ListObjectsV2 with pagination (path-style, "/<bucket>?list-type=2")
+and GET of objects with HTTP range requests. The objects are held in memory, their ETag is the md5 of the content like for objects
+uploaded in one part. Error responses (503) can be injected randomly into object requests, ranges starting at given offsets can be answered with 403.
+
+Usage: python benchmarks/s3_server.py --objects 100 --object_size 65536 [--page_size 1000] [--failure_rate 0.01]
+The server prints the endpoint URL once it is ready, the objects are in the bucket "urt-benchmark" below the prefix "dataset/".
+'''
+import time
+import random
+import hashlib
+import argparse
+import threading
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+def build_objects(prefix, count, object_size, seed=0):
+    '''
+    Returns key -> content of count objects with random content, spread over a few folders like a dataset
+    '''
+    rng = random.Random(seed)
+    return {f"{prefix}sub-{i % 5:02d}/file-{i:04d}.bin": rng.randbytes(object_size) for i in range(count)}
+
+
+class S3StandIn:
+    def __init__(self, bucket="urt-benchmark", objects=None, page_size=1000, failure_rate=0.0, retry_after=1, seed=0):
+        '''
+        objects: dictionary with key -> content
+        page_size: number of keys per ListObjectsV2 response
+        failure_rate: share of object requests answered with 503 and a Retry-After header of retry_after seconds
+        '''
+        self.bucket = bucket
+        self.objects = {}
+        self.etags = {}
+        for key, content in (objects or {}).items():
+            self.put_object(key, content)
+        self.page_size = page_size
+        self.failure_rate = failure_rate
+        self.retry_after = retry_after
+        self.forbidden_ranges = set() # (key, first byte) of range requests answered with 403
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.counter_lock = threading.Lock()
+        self.counters = {"requests": 0, "list_requests": 0, "object_requests": 0, "range_requests": 0, "failures": 0, "bytes": 0}
+        self.requested_keys = []
+        self.server = None
+
+    def put_object(self, key, content, etag=None):
+        '''
+        etag: listed instead of the md5 of the content (e.g. to simulate a corrupted transfer)
+        '''
+        self.objects[key] = content
+        self.etags[key] = etag if etag is not None else hashlib.md5(content).hexdigest()
+
+    def chance(self, rate):
+        with self.random_lock:
+            return self.random.random() < rate
+
+    def count(self, key, value=1):
+        with self.counter_lock:
+            self.counters[key] += value
+
+    def start(self, host="127.0.0.1", port=0):
+        stand_in = self
+        class Handler(S3RequestHandler):
+            server_state = stand_in
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class S3RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type, headers={}):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_code(self, status, code, headers={}):
+        body = f'<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>{code}</Code></Error>'.encode("utf-8")
+        self.send_body(status, body, "application/xml", headers)
+
+    def do_GET(self):
+        state = self.server_state
+        state.count("requests")
+        url = urlparse(self.path)
+        bucket, _, key = unquote(url.path).lstrip("/").partition("/")
+        if key != "" and state.chance(state.failure_rate):
+            state.count("failures")
+            self.send_error_code(503, "SlowDown", {"Retry-After": str(state.retry_after)})
+        elif bucket != state.bucket:
+            self.send_error_code(404, "NoSuchBucket")
+        elif key == "":
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            self.send_listing(params.get("prefix", ""), params.get("continuation-token"))
+        elif key in state.objects:
+            self.send_object(key)
+        else:
+            self.send_error_code(404, "NoSuchKey")
+
+    def send_listing(self, prefix, continuation_token):
+        state = self.server_state
+        state.count("list_requests")
+        keys = sorted(key for key in state.objects if key.startswith(prefix))
+        start = int(continuation_token) if continuation_token else 0
+        page = keys[start:start + state.page_size]
+        truncated = start + state.page_size < len(keys)
+        contents = "".join(
+            f"<Contents><Key>{escape(key)}</Key><LastModified>2024-01-01T00:00:00.000Z</LastModified><ETag>&quot;{state.etags[key]}&quot;</ETag>"
+            f"<Size>{len(state.objects[key])}</Size><StorageClass>STANDARD</StorageClass></Contents>"
+            for key in page
+        )
+        next_token = f"<NextContinuationToken>{start + state.page_size}</NextContinuationToken>" if truncated else ""
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/"><Name>{state.bucket}</Name><Prefix>{escape(prefix)}</Prefix>'
+            f"<KeyCount>{len(page)}</KeyCount><MaxKeys>{state.page_size}</MaxKeys><IsTruncated>{'true' if truncated else 'false'}</IsTruncated>"
+            f"{next_token}{contents}</ListBucketResult>"
+        ).encode("utf-8")
+        self.send_body(200, body, "application/xml")
+
+    def send_object(self, key):
+        state = self.server_state
+        state.count("object_requests")
+        with state.counter_lock:
+            state.requested_keys.append(key)
+        content = state.objects[key]
+        headers = {"ETag": f'"{state.etags[key]}"', "Accept-Ranges": "bytes"}
+        range_header = self.headers.get("Range")
+        if range_header is None:
+            state.count("bytes", len(content))
+            self.send_body(200, content, "application/octet-stream", headers)
+            return
+        state.count("range_requests")
+        first, _, last = range_header.split("=", 1)[1].partition("-")
+        first, last = int(first), min(int(last) if last else len(content) - 1, len(content) - 1)
+        if (key, first) in state.forbidden_ranges:
+            self.send_error_code(403, "AccessDenied")
+            return
+        if first >= len(content):
+            self.send_error_code(416, "InvalidRange", {"Content-Range": f"bytes */{len(content)}"})
+            return
+        state.count("bytes", last - first + 1)
+        self.send_body(206, content[first:last + 1], "application/octet-stream", {**headers, "Content-Range": f"bytes {first}-{last}/{len(content)}"})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for anonymous S3 requests")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--objects", type=int, default=100)
+    parser.add_argument("--object_size", type=int, default=64*1024, help="Size of a single object in bytes")
+    parser.add_argument("--page_size", type=int, default=1000, help="Number of keys per ListObjectsV2 response")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="Share of object requests answered with 503")
+    args = parser.parse_args()
+
+    stand_in = S3StandIn(objects=build_objects("dataset/", args.objects, args.object_size), page_size=args.page_size, failure_rate=args.failure_rate)
+    print(stand_in.start(port=args.port), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stand_in.stop()
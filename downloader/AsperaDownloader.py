@@ -3,8 +3,8 @@ from utils.utils import run_subprocess, exists_command
 from downloader.Downloader import Downloader
 
 class AsperaDownloader(Downloader):
-    def __init__(self, dataset, logger, temp_dir, cache_dir, datasets, credentials=None) -> None:
-        super(AsperaDownloader, self).__init__(dataset=dataset, logger=logger, temp_dir=temp_dir, cache_dir=cache_dir, datasets=datasets)
+    def __init__(self, dataset, logger, temp_dir, cache_dir, datasets, credentials=None, **kwargs) -> None:
+        super(AsperaDownloader, self).__init__(dataset=dataset, logger=logger, temp_dir=temp_dir, cache_dir=cache_dir, datasets=datasets, **kwargs)
         try:
             self.user = credentials["TCIA"]["user"]
             self.password = credentials["TCIA"]["password"]
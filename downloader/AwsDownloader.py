@@ -1,13 +1,33 @@
 import yaml
 import subprocess
 import os
-from utils.utils import run_subprocess, exists_command
+import re
+import time
+import hashlib
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from utils.utils import md5, format_size
 from downloader.Downloader import Downloader
+from utils.s3 import parse_s3_url, list_objects, object_url, S3ObjectStore, DEFAULT_ENDPOINT
+from utils.governor import get_governor, parse_retry_after, THROTTLING_STATUS_CODES
 
 
 class AwsDownloader(Downloader):
-    def __init__(self, dataset, logger, temp_dir, cache_dir, datasets, credentials=None):
-        super(AwsDownloader, self).__init__(dataset=dataset, logger=logger, temp_dir=temp_dir, cache_dir=cache_dir, datasets=datasets)
+    '''
+    Synchronizes the objects below the url of the dataset (e.g. "//openneuro.org/ds001226") to the temporary directory with anonymous
+    S3 requests. Objects whose size and ETag match the record of a previous download are skipped, the others are downloaded in parallel
+    (concurrency), large objects in parts with range requests. The S3 endpoint can be changed with the "endpoint_url" key in datasets.yaml
+    (e.g. for MinIO or moto).
+    '''
+    # Objects from this size on are downloaded in parts of part_size bytes with parallel range requests
+    multipart_threshold = 64 * 1024**2
+    part_size = 16 * 1024**2
+    chunk_size = 1024**2
+    progress_interval = 60
+
+    def __init__(self, dataset, logger, temp_dir, cache_dir, datasets, credentials=None, **kwargs):
+        super(AwsDownloader, self).__init__(dataset=dataset, logger=logger, temp_dir=temp_dir, cache_dir=cache_dir, datasets=datasets, **kwargs)
         try:
             self.user = credentials["user"]
             self.password = credentials["password"]
@@ -15,18 +35,202 @@ class AwsDownloader(Downloader):
             self.user = None
             self.password = None
 
-    
+        self.endpoint_url = DEFAULT_ENDPOINT
+        if datasets is not None and dataset in datasets and "endpoint_url" in datasets[dataset]:
+            self.endpoint_url = datasets[dataset]["endpoint_url"]
+        self.dataset_path = os.path.join(self.temp_dir, self.dataset)
+        self.object_store = S3ObjectStore(os.path.join(temp_dir, ".s3_objects.sqlite"))
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Shared by all datasets downloaded from the endpoint at the same time, thus its limit covers the threads of all of them
+        self.governor = get_governor(f"S3 {self.endpoint_url}", self.concurrency * self.download_workers, self.logger)
+        self.counters = {"requests": 0, "retries": 0, "bytes": 0, "files": 0}
+        self.counter_lock = threading.Lock()
+
+    def count(self, counter, value=1):
+        with self.counter_lock:
+            self.counters[counter] += value
+
+    def request_counters(self):
+        with self.counter_lock:
+            return dict(self.counters)
+
+    def estimate_size(self):
+        bucket, prefix = parse_s3_url(self.datasets[self.dataset]["url"])
+        sizes = [s3_object["size"] for s3_object in list_objects(bucket, prefix, self.endpoint_url, session=self.session) if not s3_object["key"].endswith("/")]
+        return {"bytes": sum(sizes), "files": len(sizes)}
+
     def run(self):
-        url = self.datasets[self.dataset]["url"]
-        command = f"aws s3 sync --no-sign-request s3:{url} {os.path.join(self.temp_dir, self.dataset)}"
+        bucket, prefix = parse_s3_url(self.datasets[self.dataset]["url"])
         self.logger.info(f"Downloading {self.dataset} from openneuro via AWS s3")
         
-        if not exists_command("aws"):
-            raise Exception("aws command not found. Please install awscli first.")
-        
         try:
-            run_subprocess(command, logger=self.logger)
+            # Keys ending with "/" are folder markers
+            s3_objects = [s3_object for s3_object in list_objects(bucket, prefix, self.endpoint_url, session=self.session) if not s3_object["key"].endswith("/")]
+            outdated_objects = self.select_outdated_objects(bucket, prefix, s3_objects)
+            self.logger.info(f"{len(s3_objects) - len(outdated_objects)} of {len(s3_objects)} objects are up to date, downloading {len(outdated_objects)} objects ({format_size(sum(s3_object['size'] for s3_object in outdated_objects))})")
+            self.download_objects(bucket, outdated_objects)
         except Exception as e:
             # self.logger.error(f"{e}")
-            raise Exception(f"Error while downloading {self.dataset} from openneuro via AWS s3.")
-        self.logger.info("Done")
\ No newline at end of file
+            raise Exception(f"Error while downloading {self.dataset} from openneuro via AWS s3: {e}")
+        self.logger.info("Done")
+
+    def local_path(self, prefix, key):
+        path = os.path.normpath(os.path.join(self.dataset_path, key[len(prefix):]))
+        if not path.startswith(os.path.normpath(self.dataset_path) + os.sep):
+            raise Exception(f"Invalid key {key}")
+        return path
+
+    def select_outdated_objects(self, bucket, prefix, s3_objects):
+        '''
+        Returns the objects which are missing locally or differ from the recorded download (size, ETag or modified local file),
+        with their local path added
+        '''
+        records = self.object_store.get_objects(bucket, prefix)
+        outdated_objects = []
+        for s3_object in s3_objects:
+            path = self.local_path(prefix, s3_object["key"])
+            record = records.get(s3_object["key"])
+            try:
+                stat = os.stat(path)
+                local = (path, stat.st_size, s3_object["etag"], stat.st_mtime_ns)
+            except FileNotFoundError:
+                local = None
+            if record is None or local != record or record[1] != s3_object["size"]:
+                outdated_objects.append({**s3_object, "path": path})
+        return outdated_objects
+
+    def download_objects(self, bucket, s3_objects):
+        '''
+        Objects are downloaded to "<path>.part" and renamed when they are complete and verified. The parts of large objects are
+        downloaded by the same thread pool as the small objects, the thread finishing the last part of an object finishes the object.
+        '''
+        tasks = []
+        for s3_object in s3_objects:
+            os.makedirs(os.path.dirname(s3_object["path"]), exist_ok=True)
+            if s3_object["size"] >= self.multipart_threshold:
+                # The parts are written to their offsets in the preallocated file
+                with open(s3_object["path"] + ".part", "wb") as f:
+                    f.truncate(s3_object["size"])
+                parts = [(start, min(start + self.part_size, s3_object["size"]) - 1) for start in range(0, s3_object["size"], self.part_size)]
+            else:
+                parts = [None]
+            s3_object["remaining_parts"] = len(parts)
+            s3_object["failed"] = False
+            tasks += [(s3_object, part) for part in parts]
+
+        self.pending_records = {}
+        self.finished_objects = 0
+        self.last_progress_log = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self.download_part, bucket, s3_object, part, len(s3_objects)) for s3_object, part in tasks]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+            finally:
+                # Objects finished before a failure do not have to be downloaded again
+                executor.shutdown(wait=True)
+                self.write_records(bucket, flush=True)
+
+    def download_part(self, bucket, s3_object, part, total_objects):
+        '''
+        If a part fails, the remaining parts of the object are not downloaded and the ".part" file is removed
+        '''
+        url = object_url(bucket, s3_object["key"], self.endpoint_url)
+        file_path = s3_object["path"] + ".part"
+        if s3_object["failed"]:
+            return
+        try:
+            file_hash = self.get_object(url, file_path, s3_object["size"], byte_range=part)
+            with self.counter_lock:
+                s3_object["remaining_parts"] -= 1
+                if s3_object["remaining_parts"] > 0 or s3_object["failed"]:
+                    return
+
+            # The ETag is the md5 of the object unless it was uploaded in parts (then it contains a "-") or is encrypted with KMS
+            if re.fullmatch(r"[0-9a-f]{32}", s3_object["etag"]):
+                if part is not None:
+                    file_hash = md5(file_path)
+                if file_hash != s3_object["etag"]:
+                    raise Exception(f"md5 of {s3_object['key']} does not match its ETag")
+            os.replace(file_path, s3_object["path"])
+        except Exception:
+            with self.counter_lock:
+                failed_before, s3_object["failed"] = s3_object["failed"], True
+            if failed_before:
+                # Parts running while another part failed end up here if the ".part" file was already removed
+                return
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise
+
+        stat = os.stat(s3_object["path"])
+        with self.counter_lock:
+            self.counters["files"] += 1
+            self.pending_records[s3_object["key"]] = (s3_object["path"], stat.st_size, s3_object["etag"], stat.st_mtime_ns)
+            self.finished_objects += 1
+            if time.monotonic() - self.last_progress_log > self.progress_interval:
+                self.last_progress_log = time.monotonic()
+                self.logger.info(f"Downloaded {self.finished_objects} of {total_objects} objects of {self.dataset} ({format_size(self.counters['bytes'])})")
+        self.write_records(bucket)
+
+    def write_records(self, bucket, flush=False):
+        # Records are written in batches: one transaction per object is slow for datasets with many small files
+        with self.counter_lock:
+            if not self.pending_records or (len(self.pending_records) < 100 and not flush):
+                return
+            records, self.pending_records = self.pending_records, {}
+        self.object_store.set_objects(bucket, records)
+
+    def get_object(self, url, file_path, size, byte_range=None):
+        '''
+        Streams the object of the given size (or the bytes of byte_range = (first, last) to their offset) to file_path and returns the md5
+        of the received data. Failed requests and incomplete responses are retried with the backoff of the request governor.
+        '''
+        expected_size = size if byte_range is None else byte_range[1] - byte_range[0] + 1
+        headers = {"Accept-Encoding": "identity"}
+        if byte_range is not None:
+            headers["Range"] = f"bytes={byte_range[0]}-{byte_range[1]}"
+        for i in range(0, 5):
+            if i > 0:
+                self.count("retries")
+            delay = None
+            with self.governor.slot():
+                self.count("requests")
+                try:
+                    with self.session.get(url, headers=headers, stream=True, timeout=60) as response:
+                        if response.status_code in THROTTLING_STATUS_CODES or response.status_code >= 500:
+                            self.governor.failure(parse_retry_after(response.headers.get("Retry-After")))
+                            delay = self.governor.backoff(i)
+                            self.logger.debug(f"GET {url} failed with status code {response.status_code}. Waiting for {delay:.1f} seconds and retrying...")
+                        elif response.status_code not in (200, 206) or (byte_range is not None and response.status_code != 206):
+                            raise Exception(f"GET {url} failed with status code {response.status_code}")
+                        else:
+                            hash_md5 = hashlib.md5()
+                            received = 0
+                            with open(file_path, "wb" if byte_range is None else "r+b") as f:
+                                if byte_range is not None:
+                                    f.seek(byte_range[0])
+                                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                                    f.write(chunk)
+                                    hash_md5.update(chunk)
+                                    received += len(chunk)
+                                    self.count("bytes", len(chunk))
+                            if received != expected_size:
+                                raise requests.exceptions.RequestException(f"Received {received} of {expected_size} bytes")
+                            self.governor.success()
+                            return hash_md5.hexdigest()
+                except requests.exceptions.RequestException:
+                    self.governor.failure()
+                    delay = self.governor.backoff(i)
+                    self.logger.debug(f"GET {url} was interrupted. Waiting for {delay:.1f} seconds and retrying...")
+            time.sleep(delay)
+
+        raise Exception(f"Download failed {5} times for {url}.")
@@ -1,12 +1,43 @@
 
+import os
+from utils.metrics import MetricsRecorder
+
 class Downloader:
-    def __init__(self, dataset, logger, temp_dir, cache_dir, datasets) -> None:
+    def __init__(self, dataset, logger, temp_dir, cache_dir, datasets, concurrency=1, verify_workers=None, deep_verify=False, metrics=None, download_workers=1) -> None:
         self.dataset = dataset
         self.logger = logger
         self.temp_dir = temp_dir
         self.cache_dir = cache_dir
         self.datasets = datasets
 
+        # The concurrency given on the command line can be overridden per dataset in datasets.yaml
+        if datasets is not None and dataset in datasets and "concurrency" in datasets[dataset]:
+            concurrency = datasets[dataset]["concurrency"]
+        self.concurrency = max(1, int(concurrency))
+        self.verify_workers = verify_workers if verify_workers else os.cpu_count()
+        self.deep_verify = deep_verify
+        # Number of datasets downloaded at the same time (--download_workers), their threads share connection pools
+        self.download_workers = max(1, int(download_workers))
+        self.metrics = metrics if metrics is not None else MetricsRecorder()
+
+    def request_counters(self):
+        '''
+        Returns the number of requests, retries and transferred bytes so far, used for the metrics of the stages
+        '''
+        return {"requests": 0, "retries": 0, "bytes": 0}
+
+    def estimate_size(self):
+        '''
+        Returns the expected size of the download as dictionary with "bytes" and "files" (None if unknown), used by the --plan mode
+        '''
+        return {"bytes": None, "files": None}
+
+    def finished(self):
+        '''
+        Called by URT after the dataset was moved to the output directory
+        '''
+        return
+
 def run(self):
     raise Exception(f"Run method not implemented")
     
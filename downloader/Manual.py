@@ -6,8 +6,8 @@ from utils.utils import run_subprocess
 
 
 class Manual(Downloader):
-    def __init__(self, collection, logger, temp_dir, cache_dir, datasets, credentials=None):
-        super(Manual, self).__init__(dataset=collection, logger=logger, temp_dir=temp_dir, cache_dir=cache_dir, datasets=datasets)
+    def __init__(self, collection, logger, temp_dir, cache_dir, datasets, credentials=None, **kwargs):
+        super(Manual, self).__init__(dataset=collection, logger=logger, temp_dir=temp_dir, cache_dir=cache_dir, datasets=datasets, **kwargs)
 
     
     def run(self):
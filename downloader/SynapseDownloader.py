@@ -1,6 +1,9 @@
 import yaml
-from utils.utils import run_subprocess, OutputLogger, compute_checksum
+from utils.utils import run_subprocess, OutputLogger, compute_checksum, md5, redirect_output
 from downloader.Downloader import Downloader
+from utils.manifest import ChecksumManifest
+from utils.state import StateStore
+from utils.archive import extract_zip
 import synapseclient
 import contextlib
 import synapseutils
@@ -8,28 +11,43 @@ import zipfile
 import os, shutil
 
 class SynapseDownloader(Downloader):
-    def __init__(self, dataset, logger, temp_dir, cache_dir, datasets, credentials=None) -> None:
-        super(SynapseDownloader, self).__init__(dataset=dataset, logger=logger, temp_dir=temp_dir, cache_dir=cache_dir, datasets=datasets)
+    def __init__(self, dataset, logger, temp_dir, cache_dir, datasets, credentials=None, **kwargs) -> None:
+        super(SynapseDownloader, self).__init__(dataset=dataset, logger=logger, temp_dir=temp_dir, cache_dir=cache_dir, datasets=datasets, **kwargs)
         
         self.syn = synapseclient.Synapse(silent=True, cache_root_dir=self.cache_dir)
         self.synapse_file_hashes_path = os.path.join(temp_dir, ".synapse_file_hashes.yaml")
+        self.synapse_state_path = os.path.join(temp_dir, ".synapse_state.sqlite")
         self.dataset_path = os.path.join(self.temp_dir, self.dataset)
+        self.manifest = ChecksumManifest(os.path.join(temp_dir, ".file_manifest.sqlite"), workers=self.verify_workers)
 
         try:
             self.token = credentials["Synapse"]["token"]
         except:
             self.token = None
 
-        with contextlib.redirect_stderr(OutputLogger(self.logger)):
+        # Only the output of this thread is redirected: other datasets may be processed in parallel (--download_workers)
+        with redirect_output("stderr", OutputLogger(self.logger)):
             self.syn.login(authToken=self.token, silent=True)
         
-        # Create file for storing checksums of completed downloads in the temporary directory. Otherwise problems might occur when bids conversion fails and URT is restarted
-        if not os.path.isfile(self.synapse_file_hashes_path):
-            self.logger.debug(f"\"{self.synapse_file_hashes_path}\" does not yet exists: creating file.")
-            with open(self.synapse_file_hashes_path, "w") as f:
-                yaml.safe_dump({"placeholder":"placeholder"}, f)
+        # Store checksums of completed downloads in the temporary directory. Otherwise problems might occur when bids conversion fails and URT is restarted
+        self.state = StateStore(self.synapse_state_path, legacy_yaml_path=self.synapse_file_hashes_path, logger=self.logger)
 
     
+    def estimate_size(self):
+        '''
+        Sums up the sizes of the file handles without downloading the files
+        '''
+        if not "id" in self.datasets[self.dataset]:
+            raise Exception(f"The dataset {self.dataset} is missing an id in the datasets.yaml file")
+        id = self.datasets[self.dataset]["id"]
+        entity = self.syn.get(id, downloadFile=False)
+        if isinstance(entity, synapseclient.File):
+            file_ids = [id]
+        else:
+            file_ids = [file_id for dirpath, dirnames, filenames in synapseutils.walk(self.syn, id) for name, file_id in filenames]
+        sizes = [self.syn.get(file_id, downloadFile=False)._file_handle["contentSize"] for file_id in file_ids]
+        return {"bytes": sum(sizes), "files": len(sizes)}
+
     def run(self):
         if self.check_for_downloaded_data(): return
 
@@ -40,33 +58,50 @@ class SynapseDownloader(Downloader):
         self.logger.info(f"Downloading {self.dataset} from Synapse")
         
         # Download the data via synapse API
-        with contextlib.redirect_stdout(OutputLogger(self.logger)):
+        with redirect_output("stdout", OutputLogger(self.logger)):
             files = synapseutils.syncFromSynapse(self.syn, id, path=self.temp_dir, ifcollision="keep.local") 
         self.logger.debug("Done")
-        # Unpack the data
         file_path = files[0].path
-        self.logger.debug("Unpacking dataset from .zip archive")
-        output_folder = os.path.join(self.temp_dir, self.dataset)
-        output_folder_temp = os.path.join(self.temp_dir, ".tmp", self.dataset)
-        with zipfile.ZipFile(file_path, "r") as zip_ref:
-            zip_ref.extractall(output_folder_temp)
+        self.verify_archive(files[0])
 
-        # Adjust path
-        directory = os.listdir(output_folder_temp)[0]
-        dataset_dir = os.path.join(output_folder_temp, directory)
-        self.logger.debug(f"Moving dataset from {dataset_dir} to {output_folder}")
-        shutil.move(dataset_dir, output_folder)
-        shutil.rmtree(output_folder_temp)
+        # Unpack the data directly to the dataset folder, without the top-level folder of the archive
+        output_folder = os.path.join(self.temp_dir, self.dataset)
+        if os.path.exists(output_folder):
+            # Leftover of an interrupted extraction
+            shutil.rmtree(output_folder)
+        self.logger.debug(f"Unpacking dataset from .zip archive to {output_folder}")
+        try:
+            file_hashes = extract_zip(file_path, output_folder, workers=self.verify_workers)
+        except zipfile.BadZipFile as e:
+            # The CRC of every member is checked during the extraction: download the archive again in the next run
+            shutil.rmtree(output_folder, ignore_errors=True)
+            os.remove(file_path)
+            raise Exception(f"Archive of {self.dataset} is corrupted: {e}")
         os.remove(file_path)
+        # The hashes computed during the extraction are stored in the manifest, thus computing the checksum only needs to stat the files
+        self.manifest.add_file_hashes(file_hashes)
         self.add_checksum()
         # No sophisticated error handling needed for corrupted datasets: synapseutils will remove any partially downloaded dataset when interrupted
         # TODO but error handling when dataset is downloaded but BIDS conversion fails is needed
     
+    def verify_archive(self, entity):
+        '''
+        Compares the md5 of the downloaded archive with the one of its Synapse file handle. A corrupted archive is removed.
+        '''
+        expected = (getattr(entity, "_file_handle", None) or {}).get("contentMd5")
+        if expected is None:
+            self.logger.warning(f"Synapse provides no md5 for the archive of {self.dataset}: skipping verification")
+            return
+        computed = md5(entity.path)
+        if computed != expected:
+            os.remove(entity.path)
+            raise Exception(f"Archive of {self.dataset} is corrupted: md5 {computed} does not match {expected} provided by Synapse")
+        self.logger.debug(f"Verified archive of {self.dataset} against the md5 provided by Synapse")
+
     def check_for_downloaded_data(self):
-        with open(self.synapse_file_hashes_path, "r") as f:
-            synapse_checksums = yaml.safe_load(f)
+        checksum = self.state.get_checksum(self.dataset)
         
-        if self.dataset in synapse_checksums:
+        if checksum is not None:
             # If checksum exists but not the folder of the dataset remove checksum and return False
             if not os.path.isdir(self.dataset_path) and not os.path.isfile(self.dataset_path):
                 self.logger.debug(f"Path is not a file or directory: {self.dataset_path}")
@@ -74,8 +109,8 @@ class SynapseDownloader(Downloader):
                 return False
             
             path = self.dataset_path
-            computed_checksum = compute_checksum(path)
-            if synapse_checksums[self.dataset] == computed_checksum:
+            computed_checksum = compute_checksum(path, manifest=self.manifest, deep_verify=self.deep_verify)
+            if checksum == computed_checksum:
                 self.logger.info(f"Found partially processed dataset in temporary directory: skipping download")
                 return True
             else:
@@ -87,20 +122,8 @@ class SynapseDownloader(Downloader):
         return False
     
     def add_checksum(self):
-        with open(self.synapse_file_hashes_path, "r") as f:
-            synapse_checksums = yaml.safe_load(f)
-        
-        checksum = compute_checksum(self.dataset_path)
-        synapse_checksums[self.dataset] = checksum
-
-        with open(self.synapse_file_hashes_path, "w") as f:
-            yaml.safe_dump(synapse_checksums, f)
+        checksum = compute_checksum(self.dataset_path, manifest=self.manifest, deep_verify=self.deep_verify)
+        self.state.set_checksum(self.dataset, checksum)
     
     def remove_checksum(self):
-        with open(self.synapse_file_hashes_path, "r") as f:
-            synapse_checksums = yaml.safe_load(f)
-        
-        synapse_checksums.pop(self.dataset)
-
-        with open(self.synapse_file_hashes_path, "w") as f:
-                yaml.safe_dump(synapse_checksums, f)
\ No newline at end of file
+        self.state.remove_checksum(self.dataset)
\ No newline at end of file
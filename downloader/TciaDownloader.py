@@ -5,25 +5,121 @@ from datetime import datetime, timedelta
 import requests
 import sys
 import requests_cache
-import zipfile, io
+import zipfile
 from os import path
 import shutil
+import threading
+import csv
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from downloader.Downloader import Downloader
-from utils.utils import md5
+from utils.utils import md5, memory_usage, format_size
+from utils.governor import get_governor, parse_retry_after, THROTTLING_STATUS_CODES
+from utils.catalog import CatalogStore
 
-class TciaAPI:
-    def __init__(self, user=None, pw=None, logger=None, cache_dir=None):
+class TciaSession:
+    '''
+    Connection state shared by all TciaAPI objects of the process with the same API root, credentials and cache directory:
+    HTTP sessions with their connection pool, the access token and the list of collections.
+    Thus datasets downloaded one after another (or at the same time) neither open new connections nor request new tokens.
+    '''
+    sessions = {}
+    sessions_lock = threading.Lock()
+    collections_expire_after = 600 # seconds
+
+    def __init__(self, cache_dir):
         self.cached_session = requests_cache.CachedSession(os.path.join(cache_dir, "http_cache.sqlite"), backend="sqlite", expire_after=timedelta(days=2))
         self.session = requests.Session()
-        self.priviliged = False if pw==None or pw=="" else True
-        self.base_url = "https://services.cancerimagingarchive.net/nbia-api/services/v1/" if not self.priviliged else "https://services.cancerimagingarchive.net/nbia-api/services/v2/"
-        self.advanced_url = "https://services.cancerimagingarchive.net/nbia-api/services/"
-        self.logger = logger
+        self.pool_size = 0
         self.token, self.token_expires = None, None
+        self.token_lock = threading.Lock()
+        self.collections, self.collections_time = None, None
+        self.collections_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, api_root, user, pw, cache_dir, pool_size):
+        with cls.sessions_lock:
+            key = (api_root, user, pw, os.path.abspath(cache_dir))
+            if key not in cls.sessions:
+                cls.sessions[key] = cls(cache_dir)
+            shared = cls.sessions[key]
+            shared.resize_pool(pool_size)
+            return shared
+
+    def resize_pool(self, pool_size):
+        '''
+        The pools have to keep one connection per thread alive: pool_size is the concurrency of a dataset times the number of datasets downloaded at the same time.
+        The adapters are only replaced if a dataset needs a larger pool (concurrency overridden in datasets.yaml), otherwise the pools with their open connections are kept.
+        '''
+        if pool_size <= self.pool_size:
+            return
+        self.pool_size = pool_size
+        # The metadata requests of parallel series go through the cached session, thus it needs the same pool size
+        for session in [self.session, self.cached_session]:
+            adapter = HTTPAdapter(pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+
+
+class TciaAPI:
+    api_root = "https://services.cancerimagingarchive.net/nbia-api/"
+
+    def __init__(self, user=None, pw=None, logger=None, cache_dir=None, concurrency=1, api_root=None, download_workers=1):
+        '''
+        api_root: root URL of the NBIA API, can be changed e.g. to use a local server for benchmarks
+        download_workers: number of datasets downloaded at the same time, each with concurrency threads
+        '''
+        if api_root is not None:
+            self.api_root = api_root.rstrip("/") + "/"
+        self.concurrency = concurrency
+        self.logger = logger
+        # Shared by all datasets downloaded from TCIA at the same time, thus its limit covers the threads of all of them
+        self.governor = get_governor("TCIA", concurrency * download_workers, logger)
+        # Sessions, token and collection list are shared with the TciaAPI objects of other datasets, the pools hold a connection per request the governor allows
+        self.shared = TciaSession.get(self.api_root, user, pw, cache_dir, self.governor.max_concurrency)
+        # Requests, retries and downloaded bytes, used for the metrics of the stages
+        self.counters = {"requests": 0, "retries": 0, "bytes": 0}
+        self.counter_lock = threading.Lock()
+        self.chunk_size = 1024 * 1024 # bytes held in memory per download thread when streaming series to disk
+        # Bytes read from the connection at once: the data of an incomplete read is lost if the connection drops, thus it is smaller than chunk_size
+        self.read_size = 64 * 1024
+        self.priviliged = False if pw==None or pw=="" else True
+        self.base_url = self.api_root + "services/v1/" if not self.priviliged else self.api_root + "services/v2/"
+        self.advanced_url = self.api_root + "services/"
         self.user = user
         self.password = pw
-        self.generate_tokens()
+        with self.token_lock:
+            if self.token_expires is None:
+                self.generate_tokens()
+
+    @property
+    def session(self):
+        return self.shared.session
+
+    @property
+    def cached_session(self):
+        return self.shared.cached_session
+
+    @property
+    def token_lock(self):
+        return self.shared.token_lock
 
+    @property
+    def token(self):
+        return self.shared.token
+
+    @token.setter
+    def token(self, token):
+        self.shared.token = token
+
+    @property
+    def token_expires(self):
+        return self.shared.token_expires
+
+    @token_expires.setter
+    def token_expires(self, token_expires):
+        self.shared.token_expires = token_expires
     
     def dict_to_dataframe(func):
         def wrapper(*args, **kwargs):
@@ -33,7 +129,7 @@ class TciaAPI:
         return wrapper
 
     def get_token(self, user, pw):
-        token_url = "https://services.cancerimagingarchive.net/nbia-api/oauth/token"
+        token_url = self.api_root + "oauth/token"
         token_alt = "https://keycloak-stg.dbmi.cloud/auth/realms/TCIA/protocol/openid-connect/token"
 
         params = {'client_id': 'nbia',
@@ -77,10 +173,17 @@ class TciaAPI:
     
     def renew_tokens(self):
         if datetime.now() > self.token_expires:
-            self.logger.info("Renewing token")
-            self.generate_tokens()
+            with self.token_lock:
+                # Another thread might have renewed the token while waiting for the lock
+                if datetime.now() > self.token_expires:
+                    self.logger.info("Renewing token")
+                    self.generate_tokens()
         return
 
+    def count(self, key, value=1):
+        with self.counter_lock:
+            self.counters[key] += value
+
     def get_call_headers(self):
         if self.token == None:
             api_call_headers = None
@@ -116,39 +219,117 @@ class TciaAPI:
 
         raise Exception(f"Request failed {5} times for {url}.")
     
-    def get_request(self, url, params={}, use_cache=True, advanced_api=False):
+    def get_request(self, url, params={}, use_cache=True, advanced_api=False, stream=False, headers=None, status_codes=(200,), governed=True):
+        '''
+        headers: additional headers for the request
+        status_codes: status codes which are returned to the caller, any other status code is retried
+        governed: whether the request takes a slot of the request governor, False if the caller already holds one
+        '''
         data = None
         #self.logger.debug(f"Requesting {url} with params {params}")
         self.renew_tokens()
         
         for i in range(0, 10):
             timeout = ((i+5)**2)
+            self.count("requests")
+            if i > 0:
+                self.count("retries")
+            call_headers = {**(self.get_call_headers() or {}), **(headers or {})} or None
+            if governed:
+                self.governor.acquire()
             try:
                 if use_cache:
-                    data = self.cached_session.get(url = url, headers=self.get_call_headers(), params=params, timeout=timeout)
+                    data = self.cached_session.get(url = url, headers=call_headers, params=params, timeout=timeout)
                 else:
-                    data = self.session.get(url = url, headers=self.get_call_headers(), params=params, timeout=timeout)
+                    data = self.session.get(url = url, headers=call_headers, params=params, timeout=timeout, stream=stream)
             except Exception as e:
                 if isinstance(e, KeyboardInterrupt):
                     sys.exit()
-                self.logger.debug(f"GET request failed for {url} with params {params} after timeout of {timeout} seconds. Retrying...")
-                continue
+                self.governor.failure()
+                delay = self.governor.backoff(i)
+                self.logger.debug(f"GET request failed for {url} with params {params} after timeout of {timeout} seconds. Waiting for {delay:.1f} seconds and retrying...")
             else:
-                if data.status_code != 200:
-                    self.logger.debug(f"GET request failed for {url} with params {params} and status code {data.status_code}. Waiting for {timeout} seconds and retrying...")
-                else:   
+                if data.status_code in status_codes:
+                    self.governor.success()
                     if i > 0:
                         self.logger.debug(f"GET request successful for {url} with status code {data.status_code}. Answer took {data.elapsed.total_seconds()} seconds.")
                     return data
+
+                retry_after = None
+                if data.status_code in THROTTLING_STATUS_CODES:
+                    retry_after = parse_retry_after(data.headers.get("Retry-After"))
+                    self.governor.failure(retry_after=retry_after)
+                elif data.status_code >= 500:
+                    self.governor.failure()
+                delay = retry_after if retry_after is not None else self.governor.backoff(i)
+                self.logger.debug(f"GET request failed for {url} with params {params} and status code {data.status_code}. Waiting for {delay:.1f} seconds and retrying...")
+                data.close()
+            finally:
+                if governed:
+                    self.governor.release()
+            time.sleep(delay)
                 
         raise Exception(f"Request failed {10} times for {url}.")
+
+    def download_file(self, url, file_path, params={}):
+        '''
+        Streams the response of a GET request to file_path: only one chunk of the response is held in memory at a time.
+        Data already in file_path (e.g. from an interrupted download) is kept and only the rest is requested with a HTTP range request.
+        If the server does not support range requests the download starts from the beginning.
+        '''
+        for i in range(0, 5):
+            if i > 0:
+                self.count("retries")
+            offset = os.path.getsize(file_path) if os.path.isfile(file_path) else 0
+            # No content encoding: the range refers to the bytes stored in the file
+            headers = {"Accept-Encoding": "identity"}
+            if offset > 0:
+                headers["Range"] = f"bytes={offset}-"
+            # The slot of the request governor is held until the whole file is transferred, the backoff after a failure is not
+            delay = None
+            with self.governor.slot():
+                data = self.get_request(url=url, params=params, use_cache=False, stream=True, headers=headers, status_codes=(200, 206, 416), governed=False)
+                try:
+                    if data.status_code == 416:
+                        # The partial file does not fit the file on the server (anymore)
+                        self.logger.debug(f"Range request for {url} with params {params} not satisfiable, restarting the download.")
+                        os.remove(file_path)
+                        continue
+                    if offset > 0 and data.status_code == 206:
+                        self.logger.debug(f"Resuming download of {url} with params {params} at {format_size(offset)}")
+                        mode = "ab"
+                    else:
+                        if offset > 0:
+                            self.logger.debug(f"Server does not support range requests for {url}, restarting the download.")
+                        mode = "wb"
+                    with open(file_path, mode) as f:
+                        for chunk in data.iter_content(chunk_size=self.read_size):
+                            f.write(chunk)
+                            self.count("bytes", len(chunk))
+                except requests.exceptions.RequestException:
+                    self.governor.failure()
+                    delay = self.governor.backoff(i)
+                    self.logger.debug(f"Download of {url} with params {params} was interrupted. Waiting for {delay:.1f} seconds and retrying...")
+                finally:
+                    data.close()
+            if delay is None:
+                return
+            time.sleep(delay)
+        
+        raise Exception(f"Download failed {5} times for {url}.")
             
     def getCollection(self):
-        self.logger.debug(f"Requesting available collections")
-        url = self.base_url + "getCollectionValues"
-        data = self.get_request(url=url, use_cache=False)
-        collections = data.json() # list of dictionaries with {"Collection": collection_name}
-        return collections
+        '''
+        The list of collections is requested at most once per TciaSession.collections_expire_after seconds
+        '''
+        with self.shared.collections_lock:
+            if self.shared.collections is None or time.monotonic() - self.shared.collections_time > self.shared.collections_expire_after:
+                self.logger.debug(f"Requesting available collections")
+                url = self.base_url + "getCollectionValues"
+                data = self.get_request(url=url, use_cache=False)
+                self.shared.collections = data.json() # list of dictionaries with {"Collection": collection_name}
+                self.shared.collections_time = time.monotonic()
+            return self.shared.collections
     
     def check_collection(self, collection_name):
         available_collections = self.getCollection()
@@ -189,7 +370,45 @@ class TciaAPI:
         return self.getDicomTags(SeriesUID=SeriesUID)
     
     
-    def downloadSeriesInstance(self, SeriesInstanceUID, directory, md5=True):
+    def extract_series(self, zip_path, path):
+        '''
+        Extracts the series archive to path and computes the md5 hash of every .dcm file while it is written to disk.
+        Returns whether the hashes match the ones from the md5hashes.csv file of the archive (None if the archive contains no md5hashes.csv).
+        '''
+        computed_md5 = []
+        real_md5 = None
+        real_path = os.path.realpath(path)
+        with zipfile.ZipFile(zip_path) as zip_file:
+            for member in zip_file.infolist():
+                member_path = os.path.realpath(os.path.join(path, member.filename))
+                if not member_path.startswith(real_path + os.sep):
+                    raise Exception(f"Invalid path {member.filename} in archive {zip_path}")
+                if member.is_dir():
+                    os.makedirs(member_path, exist_ok=True)
+                    continue
+                
+                os.makedirs(os.path.dirname(member_path), exist_ok=True)
+                hash_md5 = hashlib.md5()
+                with zip_file.open(member) as source, open(member_path, "wb") as target:
+                    for chunk in iter(lambda: source.read(self.chunk_size), b""):
+                        hash_md5.update(chunk)
+                        target.write(chunk)
+                
+                if member.filename.endswith(".dcm"):
+                    computed_md5.append(hash_md5.hexdigest())
+                if member.filename.endswith("md5hashes.csv"):
+                    with open(member_path, newline="") as f:
+                        real_md5 = [row["MD5Hash"] for row in csv.DictReader(f)]
+        
+        if real_md5 is None:
+            return None
+        return sorted(computed_md5) == sorted(real_md5)
+    
+    def downloadSeriesInstance(self, SeriesInstanceUID, directory, md5=True, on_verified=None):
+        '''
+        Returns the path of the series if its files were verified against the md5 hashes during extraction, None otherwise.
+        on_verified(SeriesInstanceUID, path) is called as soon as the series is verified (e.g. to add it to an archive).
+        '''
         self.logger.debug(f"Downloading {SeriesInstanceUID} to {directory}")
         if md5:
             SeriesInstanceUIDURL = "getImageWithMD5Hash"
@@ -197,20 +416,58 @@ class TciaAPI:
             SeriesInstanceUIDURL = "getImage"
         url = self.base_url + SeriesInstanceUIDURL
         params = {"SeriesInstanceUID": SeriesInstanceUID}
-        data = self.get_request(url=url, params=params, use_cache=False)
         
         path = directory + "/" + SeriesInstanceUID
-        with zipfile.ZipFile(io.BytesIO(data.content)) as zip_file:
-            zip_file.extractall(path=path)
-        return
+        # The archive is stored next to the series folder: an existing series folder marks the series as downloaded.
+        # The archive is kept if the download fails, thus the next attempt (also after a restart) resumes it.
+        zip_path = path + ".zip.part"
+        memory_before = memory_usage()
+        for i in range(0, 3):
+            self.download_file(url=url, file_path=zip_path, params=params)
+            try:
+                verified = self.extract_series(zip_path, path)
+            except zipfile.BadZipFile:
+                verified = False
+            finally:
+                os.remove(zip_path)
+            
+            if verified == False:
+                # Corrupted series are removed right away, if all attempts fail the series is downloaded again in the next round of TciaDownloader.download_series
+                self.logger.warning(f"Corrupted series {SeriesInstanceUID}: invalid archive or md5 hashes do not match.")
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            
+            memory_after = memory_usage()
+            if memory_after is not None:
+                # The resident memory of the whole process, thus the change includes the other download threads
+                self.logger.debug(f"Finished {SeriesInstanceUID}: resident memory of the process is {memory_after:.1f} MB ({memory_after - memory_before:+.1f} MB since the download of the series started)")
+            else:
+                self.logger.debug(f"Finished {SeriesInstanceUID}")
+            if verified and on_verified is not None:
+                on_verified(SeriesInstanceUID, path)
+            return path if verified else None
+        return None
 
     
-    def downloadSeries(self, series, path):
+    def downloadSeries(self, series, path, on_verified=None):
+        '''
+        Returns the paths of all series which were verified during the download, see downloadSeriesInstance for on_verified
+        '''
         assert(isinstance(series, pd.DataFrame))
-        self.logger.info(f"Downloading {len(series)} series to {path}")
-        for i, row in series.iterrows():
-            self.downloadSeriesInstance(row["SeriesInstanceUID"], path)
-        return
+        self.logger.info(f"Downloading {len(series)} series to {path} using {self.concurrency} parallel downloads")
+        verified_paths = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self.downloadSeriesInstance, SeriesInstanceUID, path, on_verified=on_verified) for SeriesInstanceUID in series["SeriesInstanceUID"]]
+            try:
+                for future in as_completed(futures):
+                    verified_path = future.result()
+                    if verified_path is not None:
+                        verified_paths.append(verified_path)
+            except BaseException:
+                # Do not start any queued downloads after a failure, running downloads are finished before the exception is raised
+                executor.shutdown(cancel_futures=True)
+                raise
+        return verified_paths
     
     def getSeriesInstanceMetadata(self, SeriesInstanceUID):
         self.logger.debug(f"Requesting metadata for SeriesInstanceUID {SeriesInstanceUID}")
@@ -221,95 +478,138 @@ class TciaAPI:
         metadata = data.json()
         return metadata
     
-    def getSeriesMetadataDF(self, SeriesUID):
+    def getSeriesMetadata(self, SeriesInstanceUIDs, log_every=100):
+        '''
+        Returns a dictionary with SeriesInstanceUID -> list of metadata records, in the order of SeriesInstanceUIDs.
+        getSeriesMetaData only accepts a single SeriesInstanceUID, thus the requests are sent in parallel
+        '''
+        metadata = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            # map keeps the order of the series
+            for i, (SeriesInstanceUID, SeriesInstanceMetadata) in enumerate(zip(SeriesInstanceUIDs, executor.map(self.getSeriesInstanceMetadata, SeriesInstanceUIDs)), start=1):
+                metadata[SeriesInstanceUID] = SeriesInstanceMetadata
+                if i % log_every == 0 or i == len(SeriesInstanceUIDs):
+                    self.logger.info(f"Downloaded metadata for {i} of {len(SeriesInstanceUIDs)} series")
+        return metadata
+
+    def getSeriesMetadataDF(self, SeriesUID, log_every=100):
         self.logger.info("Downloading metadata")
         '''
         Returns more metadata than just "getSeries"
         '''
         assert(isinstance(SeriesUID, pd.DataFrame))
-        meta_data_df = pd.DataFrame()
-        
-        for i, row in SeriesUID.iterrows():
-            SeriesInstanceUID = row["SeriesInstanceUID"]
-            SeriesInstanceMetadata = self.getSeriesInstanceMetadata(SeriesInstanceUID)
-            meta_data_df = pd.concat([meta_data_df, pd.DataFrame(SeriesInstanceMetadata)], ignore_index=True)
-        return meta_data_df
+        SeriesInstanceUIDs = list(SeriesUID["SeriesInstanceUID"]) if not SeriesUID.empty else []
+        metadata = self.getSeriesMetadata(SeriesInstanceUIDs, log_every=log_every)
+        return pd.DataFrame([record for records in metadata.values() for record in records])
             
     
-    def getSeries(self, collection_name):
+    def getSeries(self, collection_name, use_cache=True):
         '''
         Returns less metadata than "getSeriesInstanceMetadata", but is more flexible with respect to the parameters
+        use_cache: False to get the current list of series instead of a cached one (up to 2 days old)
         '''
         SeriesURL = "getSeries"
         url = self.base_url + SeriesURL
         params = {"Collection": collection_name}
-        data = self.get_request(url=url, params=params)
+        data = self.get_request(url=url, params=params, use_cache=use_cache)
         series = data.json()
         return series
     
     @dict_to_dataframe
-    def getSeriesDF(self, collection_name):
-        return self.getSeries(collection_name=collection_name)
+    def getSeriesDF(self, collection_name, use_cache=True):
+        return self.getSeries(collection_name=collection_name, use_cache=use_cache)
     
 
 class TciaDownloader(Downloader):
-    def __init__(self, credentials=None, temp_dir="", dataset=None, logger=None, cache_dir=None, datasets=None) -> None:
-        super(TciaDownloader, self).__init__(dataset=dataset, logger=logger, temp_dir=os.path.join(temp_dir, dataset), cache_dir=cache_dir, datasets=datasets)
+    def __init__(self, credentials=None, temp_dir="", dataset=None, logger=None, cache_dir=None, datasets=None, **kwargs) -> None:
+        super(TciaDownloader, self).__init__(dataset=dataset, logger=logger, temp_dir=os.path.join(temp_dir, dataset), cache_dir=cache_dir, datasets=datasets, **kwargs)
         try:
             self.user = credentials["TCIA"]["user"]
             self.password = credentials["TCIA"]["password"]
         except:
             self.user = None
             self.password = None
-        self.tcia_api = TciaAPI(user=self.user, pw=self.password, logger=logger, cache_dir=cache_dir)
+        # The API can be changed per dataset in datasets.yaml with the key "api_root" (e.g. for a local test server)
+        api_root = datasets[dataset].get("api_root") if datasets is not None and dataset in datasets else None
+        self.tcia_api = TciaAPI(user=self.user, pw=self.password, logger=logger, cache_dir=cache_dir, concurrency=self.concurrency, api_root=api_root, download_workers=self.download_workers)
         self.series_metadata_df = None
         self.seriesDF = None
+        self.series_catalog = None
+        self.verified_series = {} # path of the series -> folder_state of the series at the time of the verification
+        self.hash_counters = {"files": 0, "bytes": 0} # files hashed by compute_md5_folder, used for the metrics of the stages
+        self.catalog_store = CatalogStore(os.path.join(cache_dir, "tcia_catalog.sqlite"))
+        self.mirror_entries = None # SeriesInstanceUID -> (signature, relative path) of all series of the collection
+        self.sync_output_dir = None # set by URT: only series missing or changed in this folder are downloaded
+        self.outdated_paths = []
+        self.archive = None # set by URT: verified series are written to this StreamingArchive and removed right after their download
+        self.archived_series = set()
 
         # check if collection exists
         self.tcia_api.check_collection(self.dataset)
     
     
-    def convert_StudyInstance_path(self, root_path, SeriesUID):  
-        # Get entries from series dataframe and metadata dataframe
-        entry_df = self.seriesDF[self.seriesDF["SeriesInstanceUID"] == SeriesUID]
-        entry_metadata_df = self.series_metadata_df[self.series_metadata_df["Series UID"] == SeriesUID]
+    def request_counters(self):
+        with self.tcia_api.counter_lock:
+            return dict(self.tcia_api.counters)
+
+    def build_series_catalog(self):
+        '''
+        Builds the series catalog: one entry per SeriesInstanceUID containing the target path of the series relative to the dataset folder.
+        All paths are computed in one pass over the series and metadata dataframes instead of filtering them for every single series.
+        '''
+        # TCIA returns no series (thus a dataframe without columns) e.g. for restricted collections without credentials
+        if "SeriesInstanceUID" not in self.seriesDF:
+            self.series_catalog = pd.DataFrame({"SeriesInstanceUID": pd.Series(dtype=str), "relative_path": pd.Series(dtype=str)}).set_index("SeriesInstanceUID", drop=False)
+            return
+        catalog = self.seriesDF.drop_duplicates("SeriesInstanceUID").set_index("SeriesInstanceUID", drop=False)
+
+        if catalog.empty:
+            catalog["relative_path"] = pd.Series(dtype=str)
+            self.series_catalog = catalog
+            return
 
-        if entry_df.empty:
+        if self.series_metadata_df is not None and "Series UID" in self.series_metadata_df:
+            metadata_df = self.series_metadata_df.drop_duplicates("Series UID")
+            study_descriptions = dict(zip(metadata_df["Series UID"], metadata_df["Study Description"]))
+        else:
+            study_descriptions = {}
+        StudyDescription = pd.Series([study_descriptions.get(SeriesUID) for SeriesUID in catalog.index], index=catalog.index, dtype=object)
+        
+        if "SeriesDate" in catalog:
+            # In some cases image metadata does not contain the SeriesDate which leads to NaN in the dataframe
+            date = pd.to_datetime(catalog["SeriesDate"], format="%Y-%m-%d %H:%M:%S.%f").dt.strftime("%d-%m-%Y").fillna("unknown_date")
+        else:
+            date = "unkown_date"
+        
+        entries = pd.DataFrame({
+            "SeriesInstanceUID": catalog["SeriesInstanceUID"],
+            "StudyInstanceUID": catalog["StudyInstanceUID"],
+            "SeriesDescription": catalog["SeriesDescription"],
+            "SeriesNumber": catalog["SeriesNumber"],
+            "StudyDescription": StudyDescription,
+        })
+        for SeriesUID, entry in entries[entries.isnull().any(axis=1)].iterrows():
+            self.logger.debug(f"One of the entries in the metadata is NaN. SeriesInstanceUID: {entry['SeriesInstanceUID']}, StudyInstanceUID: {entry['StudyInstanceUID']}, SeriesDescription: {entry['SeriesDescription']}, Seriesnumber: {entry['SeriesNumber']}, StudyDescription: {entry['StudyDescription']}")
+        
+        # str is applied element-wise so that the folder names are the same as the ones of earlier versions (e.g. "nan" for missing values)
+        entries = entries.apply(lambda column: column.map(str))
+        StudyInstanceUID = entries["StudyInstanceUID"].str[-5:] # last 5 digits are used as identifier (as in the original nbia downloader)
+        SeriesInstanceUID = entries["SeriesInstanceUID"].str[-5:] # last 5 digits are used as identifier (as in the original nbia downloader)
+        
+        # Construct new paths
+        catalog["relative_path"] = (catalog["PatientID"].map(str) + os.sep
+            + date + "-" + entries["StudyDescription"] + "-" + StudyInstanceUID + os.sep
+            + entries["SeriesNumber"] + "-" + entries["SeriesDescription"] + "-" + SeriesInstanceUID)
+        
+        self.series_catalog = catalog
+        self.logger.debug(f"Built series catalog with {len(catalog)} entries")
+    
+    def convert_StudyInstance_path(self, root_path, SeriesUID):
+        relative_path = self.series_catalog["relative_path"].get(SeriesUID)
+        if relative_path is None:
             return None
         else:
-        # Get metadata
-            patient_id = entry_df["PatientID"].values[0]
-            
-            
-            try:
-                SeriesDate = entry_df["SeriesDate"]
-            except:
-                date = "unkown_date"
-            else:
-                # Check if SeriesDate is NaN: In some cases image metadata does not contain the SeriesData which leads to NaN in the dataframe
-                if SeriesDate.isnull().any():
-                    self.logger.debug("SeriesDate is NaN. Using 'unkown_date' as SeriesDate instead.")
-                    date = "unknown_date"
-                else:
-                    date = str(datetime.strptime(SeriesDate.values[0], "%Y-%m-%d %H:%M:%S.%f").date().strftime("%d-%m-%Y"))
-
-            SeriesInstanceUID = entry_df["SeriesInstanceUID"]
-            StudyInstanceUID = entry_df["StudyInstanceUID"]
-            SeriesDescription = entry_df["SeriesDescription"]
-            SeriesNumber = entry_df["SeriesNumber"]
-            StudyDescription = entry_metadata_df["Study Description"]
-            self.logger.debug(f"One of the entries in the metadata is NaN. SeriesInstanceUID: {SeriesInstanceUID.values[0]}, StudyInstanceUID: {StudyInstanceUID.values[0]}, SeriesDescription: {SeriesDescription.values[0]}, Seriesnumber: {SeriesNumber.values[0]}, StudyDescription: {StudyDescription.values[0]}") if SeriesInstanceUID.isnull().any() or StudyInstanceUID.isnull().any() or SeriesDescription.isnull().any() or SeriesNumber.isnull().any() or StudyDescription.isnull().any() else None
-            
-            SeriesNumber = SeriesNumber.values[0]
-            SeriesDescription = SeriesDescription.values[0]
-            StudyInstanceUID = StudyInstanceUID.values[0][-5:] # last 5 digits are used as identifier (as in the original nbia downloader)
-            SeriesInstanceUID = SeriesInstanceUID.values[0][-5:] # last 5 digits are used as identifier (as in the original nbia downloader)
-            StudyDescription = StudyDescription.values[0]
-
-            # Construct new path
-            path = os.path.join(root_path, patient_id, f"{date}-{StudyDescription}-{StudyInstanceUID}", f"{SeriesNumber}-{SeriesDescription}-{SeriesInstanceUID}")
-            
-            return path
+            return os.path.join(root_path, relative_path)
     
     
     def rename_patients(self, folder):
@@ -346,6 +646,7 @@ class TciaDownloader(Downloader):
     def compute_md5_folder(self, folder):
         '''
         Returns the computed md5 hashes and the md5 hashes from the md5hashes.csv file for all files it can find in the folder.
+        Series which were already verified and did not change since then are skipped, the remaining files are hashed in parallel.
         '''
         
         md5_dict = {
@@ -360,27 +661,55 @@ class TciaDownloader(Downloader):
             "path": [],
         }
         
-        for root, dirs, files in os.walk(folder):
+        file_paths = []
+        checked_series = {}
+        # Normalized, thus the paths of os.walk match the paths of verified_series
+        for root, dirs, files in os.walk(os.path.normpath(folder)):
+            if not any(file.endswith(".dcm") or file.endswith("md5hashes.csv") for file in files):
+                continue
+            state = self.folder_state(root)
+            if self.verified_series.get(root) == state:
+                continue
+            checked_series[root] = state
+            
+            SeriesInstanceUID = root.split("/")[-1]
             for file in files:
-                SeriesInstanceUID = root.split("/")[-1]
                 if file.endswith(".dcm"):
                     md5_dict["path"].append(root)
                     md5_dict["SeriesInstanceUID"].append(SeriesInstanceUID)
-                        
-                    file_path = os.path.join(root, file)
-                    md5_dict["md5"].append(md5(file_path))
+                    file_paths.append(os.path.join(root, file))
                     
                 if file.endswith("md5hashes.csv"):
-                    real_md5_df = pd.read_csv(os.path.join(root, file))
-                    for index, row in real_md5_df.iterrows():
-                        real_md5_dict["path"].append(root)
-                        real_md5_dict["SeriesInstanceUID"].append(SeriesInstanceUID)
-                        real_md5_dict["md5"].append(row["MD5Hash"])
+                    with open(os.path.join(root, file), newline="") as f:
+                        for row in csv.DictReader(f):
+                            real_md5_dict["path"].append(root)
+                            real_md5_dict["SeriesInstanceUID"].append(SeriesInstanceUID)
+                            real_md5_dict["md5"].append(row["MD5Hash"])
+        
+        self.logger.debug(f"Computing md5 hashes of {len(file_paths)} files in {len(checked_series)} series using {self.verify_workers} workers")
+        # hashlib releases the GIL while hashing large buffers, thus threads are sufficient to use multiple cores
+        with ThreadPoolExecutor(max_workers=self.verify_workers) as executor:
+            md5_dict["md5"] = list(executor.map(md5, file_paths))
+        self.verified_series.update(checked_series)
+        self.hash_counters["files"] += len(file_paths)
+        self.hash_counters["bytes"] += sum(os.path.getsize(file_path) for file_path in file_paths)
+        
         md5_df = pd.DataFrame(md5_dict)
         real_md5_df = pd.DataFrame(real_md5_dict)
                     
         return md5_df, real_md5_df
     
+    def folder_state(self, folder):
+        '''
+        Name, size, mtime and inode of every file in the folder. Unlike the mtime of the folder it changes if a file is rewritten or truncated in place.
+        '''
+        state = []
+        for entry in os.scandir(folder):
+            if entry.is_file():
+                stat = entry.stat()
+                state.append((entry.name, stat.st_size, stat.st_mtime_ns, stat.st_ino))
+        return tuple(sorted(state))
+
     def get_corrupted_series_df(self, dir):
         md5_df, real_md5_df = self.compute_md5_folder(dir)
         corrupted_series_df = pd.concat([md5_df, real_md5_df]).drop_duplicates(keep=False).reset_index(drop=True)
@@ -398,6 +727,7 @@ class TciaDownloader(Downloader):
             counter = 0
             for path in set(corrupted_series_df["path"]):
                 shutil.rmtree(path)
+                self.verified_series.pop(path, None)
                 counter += 1
             if counter==0:
                 self.logger.info("No corrupted series found.")
@@ -407,34 +737,75 @@ class TciaDownloader(Downloader):
     
 
     def remove_downloaded_instances(self, series, temp_dir):
+        '''
+        Returns the series which still have to be downloaded. A series counts as downloaded if a folder named after its SeriesInstanceUID
+        exists anywhere in temp_dir or if its renamed folder exists (the script might have been interrupted during renaming).
+        temp_dir is scanned only once, afterwards every series is checked with set lookups.
+        '''
         self.logger.info("Checking for downloaded instances")
         meta_data_df = pd.DataFrame.from_dict(series)
-        meta_data_df_pruned = meta_data_df
+        # No series (thus a dataframe without columns), e.g. for restricted collections without credentials
+        if "SeriesInstanceUID" not in meta_data_df:
+            self.logger.info(f"Found 0 downloaded instances in '{temp_dir}'")
+            return meta_data_df
         
+        existing_dirs = set()
+        existing_paths = set()
         for root, dirs, files in os.walk(temp_dir):
-            for dir in dirs:
-                meta_data_df_pruned = meta_data_df_pruned[meta_data_df_pruned["SeriesInstanceUID"] != dir]
+            existing_dirs.update(dirs)
+            existing_paths.update(os.path.join(root, dir) for dir in dirs)
         
+        downloaded = meta_data_df["SeriesInstanceUID"].isin(existing_dirs) | meta_data_df["SeriesInstanceUID"].isin(self.archived_series)
+        if "path" in meta_data_df:
+            downloaded |= meta_data_df["path"].isin(existing_paths)
         
-        for index, row in self.seriesDF.iterrows():
-            path = self.convert_StudyInstance_path(temp_dir, row["SeriesInstanceUID"])
-            if os.path.exists(path):
-                meta_data_df_pruned = meta_data_df_pruned[meta_data_df_pruned["SeriesInstanceUID"] != row["SeriesInstanceUID"]]
+        for pruned_entry in meta_data_df.loc[downloaded, "SeriesInstanceUID"]:
+            self.logger.debug(f"Skipping instance {pruned_entry}: downloaded")
+        self.logger.info(f"Found {downloaded.sum()} downloaded instances in '{temp_dir}'")
         
-        difference_df = pd.concat([meta_data_df, meta_data_df_pruned]).drop_duplicates(keep=False)
-        if not difference_df.empty:
-            for index, row in difference_df.iterrows():
-                pruned_entry = row["SeriesInstanceUID"]
-                self.logger.debug(f"Skipping instance {pruned_entry}: downloaded")
+        meta_data_df_pruned = meta_data_df[~downloaded]
+        if "FileSize" in meta_data_df_pruned:
+            self.logger.info(f"{len(meta_data_df_pruned)} series pending with a total size of {format_size(meta_data_df_pruned['FileSize'].sum())}")
+        else:
+            self.logger.info(f"{len(meta_data_df_pruned)} series pending")
         
-        self.logger.info(f"Found {len(difference_df)} downloaded instances in '{temp_dir}'")
-
         return meta_data_df_pruned
 
 
+    def series_signatures(self, series_df):
+        '''
+        Returns a dictionary with SeriesInstanceUID -> signature. A series whose signature differs from the stored one changed on TCIA.
+        '''
+        columns = [column for column in ["ImageCount", "FileSize"] if column in series_df] or list(series_df.columns)
+        
+        def signature_value(value):
+            # Integer columns become float columns if a value is missing
+            if isinstance(value, float) and value.is_integer():
+                value = int(value)
+            return str(value)
+        
+        return {entry["SeriesInstanceUID"]: "/".join(signature_value(entry[column]) for column in columns) for entry in series_df.to_dict("records")}
+    
     def download_series_metadata(self, csv_filename):
+        '''
+        The metadata of series which did not change since the last run is taken from the catalog store instead of requesting it again
+        '''
         self.logger.debug("Downloading metadata")
-        series_metadata_df = self.tcia_api.getSeriesMetadataDF(self.seriesDF)
+        signatures = self.series_signatures(self.seriesDF)
+        stored_metadata = self.catalog_store.get_metadata(self.dataset)
+        missing = [SeriesUID for SeriesUID, signature in signatures.items() if SeriesUID not in stored_metadata or stored_metadata[SeriesUID][0] != signature]
+        self.logger.info(f"Metadata of {len(signatures) - len(missing)} series found in the catalog, {len(missing)} series need to be requested")
+        
+        new_metadata = {}
+        if len(missing) > 0:
+            self.logger.info("Downloading metadata")
+            new_metadata = self.tcia_api.getSeriesMetadata(missing)
+            self.catalog_store.set_metadata(self.dataset, {SeriesUID: (signatures[SeriesUID], records) for SeriesUID, records in new_metadata.items()})
+        
+        records = []
+        for SeriesUID in signatures:
+            records.extend(new_metadata[SeriesUID] if SeriesUID in new_metadata else stored_metadata[SeriesUID][1])
+        series_metadata_df = pd.DataFrame(records)
         self.series_metadata_df = series_metadata_df
         series_metadata_df.to_csv(csv_filename, index=False)
         return
@@ -452,15 +823,80 @@ class TciaDownloader(Downloader):
                 if i>1:
                     self.logger.warning(f"Download failed. Retrying in {timeout} seconds...")
                     time.sleep(timeout)
-                self.tcia_api.downloadSeries(series_to_download, path=self.temp_dir)
-                self.remove_corrupted_series(self.temp_dir)
+                with self.metrics.stage(self.dataset, "series_download", counters=self.request_counters):
+                    verified_paths = self.tcia_api.downloadSeries(series_to_download, path=self.temp_dir, on_verified=self.archive_series if self.archive is not None else None)
+                # Series verified during the download do not have to be read again by remove_corrupted_series
+                for verified_path in verified_paths:
+                    if not os.path.isdir(verified_path):
+                        continue # archived
+                    self.verified_series[os.path.normpath(verified_path)] = self.folder_state(verified_path)
+                with self.metrics.stage(self.dataset, "verify", counters=lambda: dict(self.hash_counters)):
+                    self.remove_corrupted_series(self.temp_dir)
             
         raise Exception("Download failed. Please check your internet connection and try again.")
         
+    def archive_series(self, SeriesInstanceUID, path):
+        '''
+        Adds a verified series to self.archive with its final path (the one rename_patients would give it) and removes it from the temporary directory
+        '''
+        relative_path = self.series_catalog["relative_path"].get(SeriesInstanceUID)
+        if relative_path is None:
+            return
+        self.archive.add(path, arcname=os.path.join(self.dataset, relative_path), remove=True)
+        self.archived_series.add(SeriesInstanceUID)
+
+    def select_series_to_sync(self):
+        '''
+        Returns the series which are new or changed compared to the dataset in self.sync_output_dir.
+        Series without an entry in the catalog store (e.g. downloaded by an older version of URT) count as unchanged if their folder exists.
+        Folders of changed series are remembered in self.outdated_paths and removed after the download.
+        '''
+        mirrored = self.catalog_store.get_mirrored_series(self.dataset)
+        new_series, changed_series = [], []
+        self.outdated_paths = []
+        for SeriesUID, (signature, relative_path) in self.mirror_entries.items():
+            if SeriesUID in mirrored:
+                if mirrored[SeriesUID][0] != signature:
+                    changed_series.append(SeriesUID)
+                    self.outdated_paths.append(os.path.join(self.sync_output_dir, mirrored[SeriesUID][1]))
+            elif not os.path.isdir(os.path.join(self.sync_output_dir, relative_path)):
+                new_series.append(SeriesUID)
+        
+        removed_series = set(mirrored) - set(self.mirror_entries)
+        self.logger.info(f"Synchronizing: {len(new_series)} new and {len(changed_series)} changed series")
+        if len(removed_series) > 0:
+            self.logger.info(f"{len(removed_series)} series are not available on TCIA anymore, they are kept in {self.sync_output_dir}")
+        if "SeriesInstanceUID" not in self.seriesDF:
+            # No series on TCIA (thus a dataframe without columns)
+            return self.seriesDF.copy()
+        return self.seriesDF[self.seriesDF["SeriesInstanceUID"].isin(new_series + changed_series)].copy()
+    
+    def remove_outdated_series(self):
+        for outdated_path in self.outdated_paths:
+            if os.path.isdir(outdated_path):
+                self.logger.info(f"Removing outdated series {outdated_path}")
+                shutil.rmtree(outdated_path)
+    
+    def estimate_size(self):
+        series_df = self.tcia_api.getSeriesDF(self.dataset)
+        # TCIA returns no series (thus a dataframe without columns) e.g. for restricted collections without credentials
+        if "SeriesInstanceUID" not in series_df:
+            return {"bytes": 0, "files": 0, "series": 0}
+        series_df = series_df.drop_duplicates("SeriesInstanceUID")
+        return {
+            "bytes": int(series_df["FileSize"].sum()) if "FileSize" in series_df else None,
+            "files": int(series_df["ImageCount"].sum()) if "ImageCount" in series_df else None,
+            "series": len(series_df),
+        }
+    
+    def finished(self):
+        # The series are in the output directory now: the next synchronization only downloads series which are new or changed from now on
+        if self.mirror_entries is not None:
+            self.catalog_store.set_mirrored_series(self.dataset, self.mirror_entries, replace=True)
+    
     def add_paths_to_series(self):
-        for index, values in self.seriesDF.iterrows():
-            path = self.convert_StudyInstance_path(self.temp_dir, values["SeriesInstanceUID"])
-            self.seriesDF.at[index, "path"] = path
+        relative_paths = self.seriesDF["SeriesInstanceUID"].map(self.series_catalog["relative_path"]) if "SeriesInstanceUID" in self.seriesDF else []
+        self.seriesDF["path"] = [os.path.join(self.temp_dir, relative_path) for relative_path in relative_paths]
         
     def remove_unkown_instances(self):
         for root, dirs, files in os.walk(self.temp_dir):
@@ -476,11 +912,21 @@ class TciaDownloader(Downloader):
         
         os.makedirs(self.temp_dir, exist_ok=True)
         
-        # Get series from tcia api as dataframe
-        self.seriesDF = self.tcia_api.getSeriesDF(self.dataset)
+        with self.metrics.stage(self.dataset, "metadata", counters=self.request_counters):
+            # Get series from tcia api as dataframe
+            self.seriesDF = self.tcia_api.getSeriesDF(self.dataset, use_cache=self.sync_output_dir is None)
+            
+            # Download metadata
+            self.download_series_metadata(csv_filename=path.join(self.temp_dir, "metadata.csv"))
+        
+        # Precompute the target paths of all series
+        self.build_series_catalog()
+        signatures = self.series_signatures(self.seriesDF)
+        self.mirror_entries = {SeriesUID: (signatures[SeriesUID], relative_path) for SeriesUID, relative_path in self.series_catalog["relative_path"].items()}
         
-        # Download metadata
-        self.download_series_metadata(csv_filename=path.join(self.temp_dir, "metadata.csv"))
+        # Only download series which are missing in the output directory
+        if self.sync_output_dir is not None:
+            self.seriesDF = self.select_series_to_sync()
         
         # Add paths to series
         self.add_paths_to_series()
@@ -492,5 +938,10 @@ class TciaDownloader(Downloader):
         self.download_series()
         
         # Rename patients
-        self.rename_patients(self.temp_dir)
+        with self.metrics.stage(self.dataset, "rename"):
+            self.rename_patients(self.temp_dir)
+        
+        # The new versions of changed series are moved to the output directory by URT
+        if self.sync_output_dir is not None:
+            self.remove_outdated_series()
                 
@@ -3,6 +3,9 @@ import shutil
 import os
 import pandas as pd
 
+# Modules which only add files to the dataset: files can be written to the archive before these modules run (see URT.streams_archive)
+add_only_modules = ["add_dseg_tsv"]
+
 def add_dseg_tsv(self, data):
     self.logger.info(f"Adding dseg.tsv file to dataset")
     
@@ -0,0 +1,184 @@
+import os
+import hashlib
+import threading
+import shutil
+import tarfile
+import zipfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# codec -> (compressor, file extension)
+CODECS = {
+    "gzip": ("pigz", ".tar.gz"),
+    "zstd": ("zstd", ".tar.zst"),
+}
+
+def compressor_command(codec, level=None, threads=None):
+    if codec not in CODECS:
+        raise Exception(f"Unknown compression codec \"{codec}\". Available codecs are: {', '.join(CODECS)}")
+    command = [CODECS[codec][0], "-c"]
+    if codec == "gzip":
+        if threads: command.append(f"-p{threads}")
+        if level is not None: command.append(f"-{level}")
+    else:
+        command.append(f"-T{threads if threads else 0}") # 0: one thread per core
+        if level is not None:
+            if level > 19: command.append("--ultra")
+            command.append(f"-{level}")
+    return command
+
+
+class StreamingArchive:
+    '''
+    Writes a tar archive through an external compressor (pigz or zstd). Files are added one after another and can be removed
+    right after they were written, thus the archive grows while the uncompressed data shrinks.
+    The archive is written to "<output_file>.part" and only renamed to output_file when it was closed successfully.
+    The output of the compressor is passed through Python, thus the md5 hash of the archive is available after close() without reading the archive again.
+    '''
+    def __init__(self, output_file, codec="gzip", level=None, threads=None, logger=None):
+        self.output_file = output_file
+        self.part_file = output_file + ".part"
+        self.logger = logger
+        self.removed_files = False # files already in the archive were deleted, they are fetched again if the archive is aborted
+        # Files of concurrent calls of add (e.g. from parallel downloads) are written one after another
+        self.lock = threading.RLock()
+        command = compressor_command(codec, level, threads)
+        if shutil.which(command[0]) is None:
+            raise Exception(f"{command[0]} command not found. Please install {command[0]} first.")
+
+        if self.logger is not None:
+            self.logger.debug(f"Writing archive {output_file} with: {' '.join(command)}")
+            # Left over by an interrupted process: a partial tar stream can not be continued
+            if os.path.exists(self.part_file):
+                self.logger.info(f"Discarding incomplete archive {self.part_file} of an earlier run")
+        self.output = open(self.part_file, "wb")
+        self.hash_md5 = hashlib.md5()
+        self.md5 = None
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.writer_error = None
+        self.writer = threading.Thread(target=self.write_output, daemon=True)
+        self.writer.start()
+        self.tar = tarfile.open(fileobj=self.process.stdin, mode="w|", format=tarfile.PAX_FORMAT)
+
+    def write_output(self, chunk_size=1024*1024):
+        try:
+            while chunk := self.process.stdout.read(chunk_size):
+                self.output.write(chunk)
+                self.hash_md5.update(chunk)
+        except BaseException as e:
+            self.writer_error = e
+            # Stops the compressor, otherwise it blocks on the full pipe
+            self.process.kill()
+
+    def add(self, path, arcname, remove=False):
+        '''
+        Adds a file or a directory (recursively, in sorted order) to the archive. With remove=True every file is deleted as soon as it is written.
+        '''
+        with self.lock:
+            self.tar.add(path, arcname=arcname, recursive=False)
+            if os.path.isdir(path) and not os.path.islink(path):
+                for entry in sorted(os.listdir(path)):
+                    self.add(os.path.join(path, entry), os.path.join(arcname, entry), remove=remove)
+                if remove:
+                    os.rmdir(path)
+            elif remove:
+                os.remove(path)
+                self.removed_files = True
+
+    def close(self):
+        self.tar.close()
+        self.process.stdin.close()
+        exitcode = self.process.wait()
+        self.writer.join()
+        self.output.close()
+        if self.writer_error is not None:
+            raise self.writer_error
+        if exitcode != 0:
+            raise Exception(f"Compressor returned non-zero exit status {exitcode} while writing {self.output_file}")
+        os.replace(self.part_file, self.output_file)
+        self.md5 = self.hash_md5.hexdigest()
+        return self.md5
+
+    def abort(self):
+        try:
+            self.tar.close()
+            self.process.stdin.close()
+        except Exception:
+            pass
+        self.process.kill()
+        self.process.wait()
+        self.writer.join()
+        self.output.close()
+        # A partial tar stream can not be continued, the archived files are downloaded or converted again by the next run
+        if os.path.exists(self.part_file):
+            os.remove(self.part_file)
+        if self.removed_files and self.logger is not None:
+            self.logger.warning(f"Writing {self.output_file} failed: the incomplete archive was removed, already archived files are downloaded or converted again in the next run")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def zip_member_targets(zip_file, target_dir, strip_top_level=True):
+    '''
+    Returns (member, target path) for all members of the archive. With strip_top_level the folder containing all members is removed
+    from the paths (macOS metadata in "__MACOSX" is skipped), thus the content of the folder is extracted directly to target_dir.
+    '''
+    members = [member for member in zip_file.infolist() if member.filename.split("/")[0] != "__MACOSX"]
+    top_level = set(member.filename.split("/")[0] for member in members)
+    strip = strip_top_level and len(top_level) == 1 and all("/" in member.filename for member in members)
+
+    real_target_dir = os.path.realpath(target_dir)
+    targets = []
+    for member in members:
+        name = member.filename.split("/", 1)[1] if strip else member.filename
+        if name in ["", "/"]:
+            continue
+        target_path = os.path.normpath(os.path.join(os.path.abspath(target_dir), name))
+        if not os.path.realpath(target_path).startswith(real_target_dir + os.sep):
+            raise Exception(f"Invalid path {member.filename} in archive {zip_file.filename}")
+        targets.append((member, target_path))
+    return targets
+
+def extract_zip(zip_path, target_dir, strip_top_level=True, workers=None, chunk_size=1024*1024):
+    '''
+    Extracts the archive directly to target_dir (see zip_member_targets), the members are extracted in parallel.
+    Every thread reads the archive through its own file handle. The CRC of every member is checked while it is read.
+    Returns a dictionary with path -> md5 of the extracted files, computed while they are written.
+    '''
+    with zipfile.ZipFile(zip_path) as zip_file:
+        targets = zip_member_targets(zip_file, target_dir, strip_top_level=strip_top_level)
+
+    os.makedirs(target_dir, exist_ok=True)
+    for member, target_path in targets:
+        os.makedirs(target_path if member.is_dir() else os.path.dirname(target_path), exist_ok=True)
+    files = [(member, target_path) for member, target_path in targets if not member.is_dir()]
+
+    handles = threading.local()
+    opened = []
+    opened_lock = threading.Lock()
+    def extract(member_target):
+        member, target_path = member_target
+        if not hasattr(handles, "zip_file"):
+            handles.zip_file = zipfile.ZipFile(zip_path)
+            with opened_lock:
+                opened.append(handles.zip_file)
+        hash_md5 = hashlib.md5()
+        with handles.zip_file.open(member) as source, open(target_path, "wb") as target:
+            for chunk in iter(lambda: source.read(chunk_size), b""):
+                hash_md5.update(chunk)
+                target.write(chunk)
+        return target_path, hash_md5.hexdigest()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(executor.map(extract, files))
+    finally:
+        for zip_file in opened:
+            zip_file.close()
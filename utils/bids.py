@@ -0,0 +1,110 @@
+import os
+import re
+import csv
+import json
+import shutil
+import hashlib
+from fnmatch import fnmatch
+
+def list_subjects(source_dir, subject_prefix):
+    '''
+    Returns the subject folders in the source directory in the same way as bidscoin selects them (by the subject prefix)
+    '''
+    pattern = "*" if subject_prefix == "*" else subject_prefix + "*"
+    return sorted(folder for folder in os.listdir(source_dir) if not folder.startswith(".") and fnmatch(folder, pattern) and os.path.isdir(os.path.join(source_dir, folder)))
+
+def bids_label(subject, subject_prefix):
+    '''
+    Returns the BIDS label bidscoin derives from a subject folder: the prefix is removed and only alphanumeric characters are kept
+    '''
+    if subject_prefix != "*":
+        subject = re.sub(f"^{re.escape(subject_prefix)}", "", subject)
+    return "sub-" + re.sub(r"[^a-zA-Z0-9]", "", subject)
+
+def compute_source_fingerprint(source_dir, subjects):
+    '''
+    Cheap checksum of the subject folders: based on the paths, sizes and modification times of all files instead of their content
+    '''
+    hash_md5 = hashlib.md5()
+    for subject in sorted(subjects):
+        for root, dirs, files in os.walk(os.path.join(source_dir, subject), topdown=True):
+            dirs.sort()
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                stat = os.stat(file_path)
+                hash_md5.update(f"{os.path.relpath(file_path, source_dir)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+    return hash_md5.hexdigest()
+
+def merge_json(source_file, target_file):
+    '''
+    Adds all keys of the source file which are missing in the target file
+    '''
+    with open(source_file, "r") as f:
+        source = json.load(f)
+    with open(target_file, "r") as f:
+        target = json.load(f)
+    for key, value in source.items():
+        target.setdefault(key, value)
+    with open(target_file, "w") as f:
+        json.dump(target, f, indent=4)
+
+def merge_participants_tsv(source_file, target_file):
+    '''
+    Merges the rows of both files by participant_id (rows of the source file replace the rows of the target file), missing values are set to "n/a"
+    '''
+    with open(target_file, "r", newline="") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        columns = list(reader.fieldnames or [])
+        rows = {row["participant_id"]: row for row in reader}
+    with open(source_file, "r", newline="") as f:
+        reader = csv.DictReader(f, delimiter="\t")
+        columns += [column for column in reader.fieldnames or [] if column not in columns]
+        for row in reader:
+            rows[row["participant_id"]] = row
+
+    with open(target_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, delimiter="\t", restval="n/a", lineterminator="\n")
+        writer.writeheader()
+        for participant_id in sorted(rows):
+            writer.writerow(rows[participant_id])
+
+def append_log(source_file, target_file):
+    with open(source_file, "r") as f:
+        lines = f.readlines()
+    # Only one header for tables
+    if source_file.endswith(".tsv") and os.path.isfile(target_file):
+        lines = lines[1:]
+    with open(target_file, "a") as f:
+        f.writelines(lines)
+
+def merge_bids_folder(source_dir, target_dir):
+    '''
+    Moves the content of a BIDS folder created by a single bidscoiner run (one shard of the subjects) into the target BIDS folder.
+    Subject folders are moved, participants files and dataset_description.json are reconciled, bidscoiner logs are appended
+    and any other file is only copied if it does not exist in the target folder yet.
+    '''
+    os.makedirs(target_dir, exist_ok=True)
+    for root, dirs, files in os.walk(source_dir, topdown=True):
+        relative_root = os.path.relpath(root, source_dir)
+        target_root = os.path.normpath(os.path.join(target_dir, relative_root))
+        os.makedirs(target_root, exist_ok=True)
+
+        if relative_root == ".":
+            for folder in [folder for folder in dirs if folder.startswith("sub-")]:
+                dirs.remove(folder)
+                target_folder = os.path.join(target_root, folder)
+                if os.path.exists(target_folder):
+                    shutil.rmtree(target_folder)
+                shutil.move(os.path.join(root, folder), target_folder)
+
+        for file in files:
+            source_file = os.path.join(root, file)
+            target_file = os.path.join(target_root, file)
+            if file.startswith("bidscoiner"):
+                append_log(source_file, target_file)
+            elif not os.path.exists(target_file):
+                shutil.copy2(source_file, target_file)
+            elif file == "participants.tsv":
+                merge_participants_tsv(source_file, target_file)
+            elif file.endswith(".json") and relative_root == ".":
+                merge_json(source_file, target_file)
@@ -0,0 +1,76 @@
+import json
+import sqlite3
+from datetime import datetime
+
+class CatalogStore:
+    '''
+    Local snapshot of the series of TCIA collections, stored in a SQLite database in the cache directory.
+    - series_metadata: the metadata of every series (getSeriesMetaData), thus the metadata of unchanged series is never requested again
+    - mirrored_series: the series which are in the output directory, with their paths relative to the dataset folder. Used by --sync
+      to download only series which are new or changed since the last run.
+    A series counts as changed if its signature (e.g. number of images and size) differs from the stored one.
+    '''
+    def __init__(self, path):
+        self.path = path
+        connection = self.connect()
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS series_metadata (collection TEXT, series_uid TEXT, signature TEXT, metadata TEXT, updated_at TEXT, PRIMARY KEY (collection, series_uid))")
+                connection.execute("CREATE TABLE IF NOT EXISTS mirrored_series (collection TEXT, series_uid TEXT, signature TEXT, relative_path TEXT, updated_at TEXT, PRIMARY KEY (collection, series_uid))")
+        finally:
+            connection.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def get_metadata(self, collection):
+        '''
+        Returns a dictionary with SeriesInstanceUID -> (signature, list of metadata records)
+        '''
+        connection = self.connect()
+        try:
+            rows = connection.execute("SELECT series_uid, signature, metadata FROM series_metadata WHERE collection = ?", (collection,)).fetchall()
+        finally:
+            connection.close()
+        return {series_uid: (signature, json.loads(metadata)) for series_uid, signature, metadata in rows}
+
+    def set_metadata(self, collection, metadata):
+        '''
+        metadata: dictionary with SeriesInstanceUID -> (signature, list of metadata records)
+        '''
+        now = datetime.now().isoformat()
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO series_metadata (collection, series_uid, signature, metadata, updated_at) VALUES (?, ?, ?, ?, ?)",
+                                       [(collection, series_uid, signature, json.dumps(records), now) for series_uid, (signature, records) in metadata.items()])
+        finally:
+            connection.close()
+
+    def get_mirrored_series(self, collection):
+        '''
+        Returns a dictionary with SeriesInstanceUID -> (signature, relative path)
+        '''
+        connection = self.connect()
+        try:
+            rows = connection.execute("SELECT series_uid, signature, relative_path FROM mirrored_series WHERE collection = ?", (collection,)).fetchall()
+        finally:
+            connection.close()
+        return {series_uid: (signature, relative_path) for series_uid, signature, relative_path in rows}
+
+    def set_mirrored_series(self, collection, series, replace=False):
+        '''
+        series: dictionary with SeriesInstanceUID -> (signature, relative path)
+        replace: remove all other series of the collection (after a full download), otherwise the series are added (after a sync)
+        '''
+        now = datetime.now().isoformat()
+        connection = self.connect()
+        try:
+            with connection:
+                if replace:
+                    connection.execute("DELETE FROM mirrored_series WHERE collection = ?", (collection,))
+                connection.executemany("INSERT OR REPLACE INTO mirrored_series (collection, series_uid, signature, relative_path, updated_at) VALUES (?, ?, ?, ?, ?)",
+                                       [(collection, series_uid, signature, relative_path, now) for series_uid, (signature, relative_path) in series.items()])
+        finally:
+            connection.close()
@@ -0,0 +1,134 @@
+import time
+import random
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Responses which mean that the server is overloaded or rate limits the client
+THROTTLING_STATUS_CODES = (429, 503)
+
+class RequestGovernor:
+    '''
+    Limits the number of parallel requests to a server with AIMD (additive increase, multiplicative decrease): every successful request
+    raises the limit slowly, every failure or throttling response halves it. Retries wait with exponential backoff and full jitter,
+    thus clients which failed at the same time do not retry in lockstep. A Retry-After header pauses all requests of the governor.
+    One governor is shared by all threads (and all datasets) using the same server, see get_governor.
+    '''
+    def __init__(self, name, max_concurrency, logger, min_concurrency=1, base_delay=1, max_delay=120, log_interval=60):
+        self.name = name
+        self.logger = logger
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(max_concurrency)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.log_interval = log_interval
+        self.active = 0
+        self.paused_until = 0
+        self.last_decrease = 0
+        self.last_log = time.monotonic()
+        self.outcomes = deque(maxlen=200) # True for successful requests
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                delay = self.paused_until - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(timeout=delay)
+                elif self.active >= int(self.limit):
+                    self.condition.wait()
+                else:
+                    break
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def slot(self):
+        return GovernorSlot(self)
+
+    def success(self):
+        with self.condition:
+            self.outcomes.append(True)
+            # Additive increase: about one additional request per round of requests at the current limit
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+        self.log_status()
+
+    def failure(self, retry_after=None):
+        with self.condition:
+            self.outcomes.append(False)
+            now = time.monotonic()
+            # Multiplicative decrease, at most once per second: requests which failed together count as one congestion event
+            if now - self.last_decrease > 1 and self.limit > self.min_concurrency:
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                self.last_decrease = now
+                self.logger.debug(f"Request governor \"{self.name}\": lowered concurrency to {int(self.limit)}, error rate {self.error_rate():.1%}")
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + retry_after)
+        self.log_status()
+
+    def backoff(self, attempt):
+        '''
+        Returns the delay before the retry with the given number (starting with 0): exponential backoff with full jitter
+        '''
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def log_status(self):
+        now = time.monotonic()
+        if now - self.last_log < self.log_interval:
+            return
+        self.last_log = now
+        self.logger.info(f"Request governor \"{self.name}\": concurrency {int(self.limit)}/{self.max_concurrency}, {self.active} active requests, error rate {self.error_rate():.1%} (last {len(self.outcomes)} requests)")
+
+
+class GovernorSlot:
+    def __init__(self, governor):
+        self.governor = governor
+
+    def __enter__(self):
+        self.governor.acquire()
+        return self.governor
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.governor.release()
+
+
+def parse_retry_after(value):
+    '''
+    Returns the delay in seconds from a Retry-After header (seconds or HTTP date), None if it is missing or invalid
+    '''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+governors = {}
+governors_lock = threading.Lock()
+
+def get_governor(name, max_concurrency, logger):
+    '''
+    Returns the governor shared by all users of the server name. Its concurrency limit is the largest max_concurrency requested for it.
+    '''
+    with governors_lock:
+        governor = governors.get(name)
+        if governor is None:
+            governor = governors[name] = RequestGovernor(name, max_concurrency, logger)
+        elif max_concurrency > governor.max_concurrency:
+            with governor.condition:
+                governor.max_concurrency = max_concurrency
+        return governor
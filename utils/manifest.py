@@ -0,0 +1,111 @@
+import os
+import sqlite3
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from utils.utils import md5
+
+class ChecksumManifest:
+    '''
+    Cache for the md5 hashes of single files, stored in a SQLite database.
+    A cached hash is only used as long as size, mtime and inode of the file are unchanged, thus unchanged files are never read twice.
+    '''
+    def __init__(self, path, workers=None):
+        self.path = path
+        self.workers = workers if workers else os.cpu_count()
+        with self.connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, md5 TEXT)")
+        connection.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def load(self, path):
+        '''
+        Returns all cached entries for the file or directory at path
+        '''
+        connection = self.connect()
+        try:
+            rows = connection.execute("SELECT path, size, mtime_ns, inode, md5 FROM files WHERE path = ? OR (path > ? AND path < ?)", (path, path + os.sep, path + os.sep + "\U0010ffff")).fetchall()
+        finally:
+            connection.close()
+        return {row[0]: (row[1], row[2], row[3], row[4]) for row in rows}
+
+    def update(self, entries, removed=()):
+        '''
+        entries: dictionary with path -> (size, mtime_ns, inode, md5)
+        '''
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, md5) VALUES (?, ?, ?, ?, ?)", [(path, *entry) for path, entry in entries.items()])
+                connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+        finally:
+            connection.close()
+
+    def add_file_hashes(self, file_hashes):
+        '''
+        Stores hashes which were computed elsewhere (e.g. while the file was written), file_hashes: dictionary with path -> md5
+        '''
+        entries = {}
+        for file_path, file_hash in file_hashes.items():
+            file_path = os.path.abspath(file_path)
+            stat = os.stat(file_path)
+            entries[file_path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino, file_hash)
+        self.update(entries)
+
+    def list_files(self, path):
+        '''
+        Lists the files in the same way as checksumdir.dirhash does
+        '''
+        if os.path.isfile(path):
+            return [path]
+        file_paths = []
+        for root, dirs, files in os.walk(path, topdown=True):
+            dirs.sort()
+            files.sort()
+            for file in files:
+                file_paths.append(os.path.join(root, file))
+        return file_paths
+
+    def compute_file_hashes(self, path, deep_verify=False):
+        '''
+        Returns a dictionary with file path -> md5 hash for all files in path. Only new or modified files are hashed unless deep_verify is given.
+        '''
+        path = os.path.abspath(path)
+        cached = self.load(path)
+        file_hashes = {}
+        stats = {}
+        to_hash = []
+        for file_path in self.list_files(path):
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                # e.g. broken symlinks: checksumdir uses the hash of an empty file
+                file_hashes[file_path] = hashlib.md5().hexdigest()
+                continue
+            stats[file_path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            entry = cached.get(file_path)
+            if not deep_verify and entry is not None and entry[:3] == stats[file_path]:
+                file_hashes[file_path] = entry[3]
+            else:
+                to_hash.append(file_path)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for file_path, file_hash in zip(to_hash, executor.map(md5, to_hash)):
+                file_hashes[file_path] = file_hash
+
+        removed = [file_path for file_path in cached if file_path not in stats]
+        self.update({file_path: (*stats[file_path], file_hashes[file_path]) for file_path in to_hash}, removed=removed)
+        return file_hashes
+
+    def compute_checksum(self, path, deep_verify=False):
+        '''
+        Returns the same checksum as utils.compute_checksum: md5 for files and checksumdir.dirhash for directories
+        '''
+        file_hashes = self.compute_file_hashes(path, deep_verify=deep_verify)
+        if os.path.isfile(path):
+            return next(iter(file_hashes.values()))
+        hash_md5 = hashlib.md5()
+        for file_hash in sorted(file_hashes.values()):
+            hash_md5.update(file_hash.encode("utf-8"))
+        return hash_md5.hexdigest()
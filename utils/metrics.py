@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+
+class MetricsRecorder:
+    '''
+    Records wall time, bytes, number of files, requests and retries of processing stages. Every finished stage is appended as one
+    JSON line to path, optionally the totals per dataset and stage are written to a Prometheus textfile (for the textfile collector
+    of the node exporter). Without path the stages are only measured, e.g. when a downloader is used outside of URT.
+    '''
+    def __init__(self, path=None, prometheus_path=None, logger=None, run_id=None):
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.logger = logger
+        self.run_id = run_id if run_id is not None else f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+        self.totals = {} # (dataset, stage) -> totals of all records
+        self.lock = threading.Lock()
+
+    def stage(self, dataset, stage, path=None, counters=None):
+        '''
+        Returns a context manager measuring a stage.
+        path: file or folder whose size and number of files are recorded at the end of the stage
+        counters: function returning a dictionary with the number of "requests", "retries", "bytes" and "files" so far (e.g. Downloader.request_counters),
+        the differences between the start and the end of the stage are recorded
+        '''
+        return StageMetrics(self, dataset, stage, path, counters)
+
+    def record(self, entry):
+        with self.lock:
+            key = (entry["dataset"], entry["stage"])
+            totals = self.totals.setdefault(key, {"wall_time_s": 0.0, "bytes": 0, "files": 0, "requests": 0, "retries": 0, "runs": 0})
+            for metric in ["wall_time_s", "bytes", "files", "requests", "retries"]:
+                totals[metric] += entry[metric] or 0
+            totals["runs"] += 1
+            totals["bytes_per_s"] = entry["bytes_per_s"]
+            totals["status"] = entry["status"]
+
+            if self.path is not None:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+            if self.prometheus_path is not None:
+                self.write_prometheus()
+
+        if self.logger is not None:
+            self.logger.debug(f"Stage \"{entry['stage']}\" of {entry['dataset']} {entry['status']} after {entry['wall_time_s']:.1f} s ({entry['bytes']} bytes, {entry['files']} files, {entry['requests']} requests, {entry['retries']} retries)")
+
+    def write_prometheus(self):
+        metrics = [
+            ("urt_stage_duration_seconds", "wall_time_s", "Wall time of the stage"),
+            ("urt_stage_bytes", "bytes", "Bytes processed by the stage"),
+            ("urt_stage_files", "files", "Files processed by the stage"),
+            ("urt_stage_requests", "requests", "HTTP requests sent during the stage"),
+            ("urt_stage_retries", "retries", "Retried HTTP requests and downloads during the stage"),
+            ("urt_stage_bytes_per_second", "bytes_per_s", "Throughput of the last run of the stage"),
+            ("urt_stage_failed", "status", "1 if the last run of the stage failed"),
+        ]
+        lines = []
+        for name, metric, description in metrics:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            for (dataset, stage), totals in sorted(self.totals.items()):
+                value = int(totals["status"] == "failed") if metric == "status" else totals[metric]
+                if value is None:
+                    value = "NaN"
+                lines.append(f"{name}{{dataset=\"{escape_label(dataset)}\",stage=\"{escape_label(stage)}\"}} {value}")
+
+        # The textfile collector may read the file at any time, thus it is replaced atomically
+        temp_path = self.prometheus_path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.prometheus_path)
+
+
+class StageMetrics:
+    def __init__(self, recorder, dataset, stage, path, counters):
+        self.recorder = recorder
+        self.dataset = dataset
+        self.stage = stage
+        self.path = path
+        self.counters = counters
+        # Can be set during the stage if they cannot be measured from path or counters
+        self.bytes = None
+        self.files = None
+
+    def __enter__(self):
+        self.start_counters = self.counters() if self.counters is not None else {}
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_time = time.perf_counter() - self.start_time
+        end_counters = self.counters() if self.counters is not None else {}
+        delta = {key: end_counters[key] - self.start_counters.get(key, 0) for key in end_counters}
+
+        if self.bytes is None and self.path is not None and os.path.exists(self.path):
+            self.bytes, self.files = path_size(self.path)
+        if self.bytes is None:
+            self.bytes = delta.get("bytes", 0)
+        if self.files is None:
+            self.files = delta.get("files")
+
+        self.recorder.record({
+            "run_id": self.recorder.run_id,
+            "timestamp": datetime.now().isoformat(),
+            "dataset": self.dataset,
+            "stage": self.stage,
+            "status": "failed" if exc_type is not None else "finished",
+            "wall_time_s": wall_time,
+            "bytes": self.bytes,
+            "files": self.files,
+            "requests": delta.get("requests", 0),
+            "retries": delta.get("retries", 0),
+            "bytes_per_s": self.bytes / wall_time if wall_time > 0 else None,
+        })
+
+
+def path_size(path):
+    '''
+    Returns the size in bytes and the number of files of a file or folder
+    '''
+    if os.path.isfile(path):
+        return os.path.getsize(path), 1
+    total_size, files = 0, 0
+    for root, dirs, file_names in os.walk(path):
+        for file in file_names:
+            try:
+                total_size += os.lstat(os.path.join(root, file)).st_size
+            except FileNotFoundError:
+                continue
+            files += 1
+    return total_size, files
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
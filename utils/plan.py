@@ -0,0 +1,64 @@
+import json
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from utils.utils import format_size
+
+ORDERS = ["largest", "smallest"]
+
+def estimate_sizes(downloaders, logger, workers=4):
+    '''
+    Returns one plan entry per URT object with the estimated size of its download. Failed estimates are logged and have no size.
+    '''
+    def estimate(downloader):
+        entry = {"dataset": downloader.dataset_name, "downloader": downloader.downloader, "bytes": None, "files": None}
+        try:
+            entry.update(downloader.downloader_instance.estimate_size())
+        except Exception as e:
+            logger.warning(f"Could not estimate the size of {downloader.dataset_name}: {e}")
+        return entry
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(estimate, downloaders))
+
+def sort_entries(entries, order="largest"):
+    '''
+    Largest-first keeps large datasets from starting last when datasets are processed in parallel. Datasets of unknown size come last.
+    '''
+    known = [entry for entry in entries if entry["bytes"] is not None]
+    unknown = [entry for entry in entries if entry["bytes"] is None]
+    return sorted(known, key=lambda entry: entry["bytes"], reverse=order == "largest") + unknown
+
+def create_plan(downloaders, logger, order="largest", failed_datasets=[]):
+    entries = sort_entries(estimate_sizes(downloaders, logger), order=order)
+    total_bytes = sum(entry["bytes"] for entry in entries if entry["bytes"] is not None)
+    plan = {
+        "created_at": datetime.now().isoformat(),
+        "order": order,
+        "total_bytes": total_bytes,
+        "datasets": entries,
+        "failed_datasets": list(failed_datasets),
+    }
+
+    logger.info(f"Download plan ({order} first):")
+    for i, entry in enumerate(entries, start=1):
+        size = format_size(entry["bytes"]) if entry["bytes"] is not None else "unknown size"
+        files = f", {entry['files']} files" if entry["files"] is not None else ""
+        series = f", {entry['series']} series" if "series" in entry else ""
+        logger.info(f"    {i}. {entry['dataset']} ({entry['downloader']}): {size}{files}{series}")
+    unknown = sum(1 for entry in entries if entry["bytes"] is None)
+    logger.info(f"Total: {format_size(total_bytes)} in {len(entries)} datasets" + (f" ({unknown} of unknown size)" if unknown else ""))
+    for dataset in failed_datasets:
+        logger.info(f"    Not downloadable: {dataset}")
+    return plan
+
+def write_plan(plan, path):
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=4)
+
+def read_plan(path):
+    '''
+    Returns the datasets of a plan in the planned order
+    '''
+    with open(path, "r") as f:
+        plan = json.load(f)
+    return [entry["dataset"] for entry in plan["datasets"]]
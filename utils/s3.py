@@ -0,0 +1,87 @@
+import sqlite3
+import requests
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime
+from urllib.parse import quote
+
+S3_NAMESPACE = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+DEFAULT_ENDPOINT = "https://s3.amazonaws.com"
+
+def parse_s3_url(url):
+    '''
+    Splits an url like "//openneuro.org/ds001226" or "s3://openneuro.org/ds001226" into bucket and key prefix (with a trailing "/", like aws s3 sync)
+    '''
+    path = url.split("s3:", 1)[-1].lstrip("/")
+    bucket, _, prefix = path.partition("/")
+    prefix = prefix.strip("/")
+    return bucket, prefix + "/" if prefix else ""
+
+def object_url(bucket, key, endpoint_url=DEFAULT_ENDPOINT):
+    return f"{endpoint_url.rstrip('/')}/{bucket}/{quote(key, safe='/~')}"
+
+def list_objects(bucket, prefix, endpoint_url=DEFAULT_ENDPOINT, session=None, timeout=60):
+    '''
+    Lists all objects below prefix with anonymous ListObjectsV2 requests (path-style, thus bucket names containing dots work with TLS).
+    Yields dictionaries with key, size, etag and last_modified of every object.
+    '''
+    session = session if session is not None else requests.Session()
+    url = f"{endpoint_url.rstrip('/')}/{bucket}"
+    params = {"list-type": "2", "prefix": prefix}
+    while True:
+        response = session.get(url, params=params, timeout=timeout)
+        if response.status_code != 200:
+            raise Exception(f"Listing s3://{bucket}/{prefix} failed with status code {response.status_code}: {response.text[:200]}")
+        root = ElementTree.fromstring(response.content)
+        for content in root.iter(f"{S3_NAMESPACE}Contents"):
+            yield {
+                "key": content.findtext(f"{S3_NAMESPACE}Key"),
+                "size": int(content.findtext(f"{S3_NAMESPACE}Size")),
+                "etag": content.findtext(f"{S3_NAMESPACE}ETag", "").strip('"'),
+                "last_modified": content.findtext(f"{S3_NAMESPACE}LastModified"),
+            }
+        if root.findtext(f"{S3_NAMESPACE}IsTruncated") != "true":
+            return
+        params["continuation-token"] = root.findtext(f"{S3_NAMESPACE}NextContinuationToken")
+
+
+class S3ObjectStore:
+    '''
+    Records of the objects downloaded from S3, stored in a SQLite database. An object is up to date if the size and ETag in the listing
+    are the recorded ones and the local file still has the recorded size and mtime, thus checking a finished download needs no reads.
+    '''
+    def __init__(self, path):
+        self.path = path
+        connection = self.connect()
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS objects (bucket TEXT, key TEXT, path TEXT, size INTEGER, etag TEXT, mtime_ns INTEGER, updated_at TEXT, PRIMARY KEY (bucket, key))")
+        finally:
+            connection.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def get_objects(self, bucket, prefix=""):
+        '''
+        Returns a dictionary with key -> (path, size, etag, mtime_ns) for all recorded objects below prefix
+        '''
+        connection = self.connect()
+        try:
+            rows = connection.execute("SELECT key, path, size, etag, mtime_ns FROM objects WHERE bucket = ? AND substr(key, 1, ?) = ?", (bucket, len(prefix), prefix)).fetchall()
+        finally:
+            connection.close()
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def set_objects(self, bucket, objects):
+        '''
+        objects: dictionary with key -> (path, size, etag, mtime_ns)
+        '''
+        now = datetime.now().isoformat()
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO objects (bucket, key, path, size, etag, mtime_ns, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                       [(bucket, key, *entry, now) for key, entry in objects.items()])
+        finally:
+            connection.close()
@@ -0,0 +1,66 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class StagedScheduler:
+    '''
+    Runs items through a sequence of stages. Every stage has its own thread pool with its own worker limit, thus different items
+    can be processed by different stages at the same time (e.g. two datasets downloading while a third one is converted).
+    Items enter the first stage in the given order. A stage function returning False ends the processing of the item without error.
+    '''
+    def __init__(self, stages, logger, describe=str):
+        '''
+        stages: list of (name, function, workers)
+        describe: function returning the name of an item for the log
+        '''
+        self.stages = stages
+        self.logger = logger
+        self.describe = describe
+
+    def run(self, items):
+        '''
+        Returns a list with the exception raised for every item (None if the item was processed successfully), in the order of the items
+        '''
+        pools = [ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name) for name, function, workers in self.stages]
+        results = {}
+        lock = threading.Lock()
+        finished = threading.Event()
+
+        def finish(index, exception):
+            with lock:
+                results[index] = exception
+                if len(results) == len(items):
+                    finished.set()
+
+        def submit(index, stage):
+            if stage == len(self.stages):
+                finish(index, None)
+                return
+            function = self.stages[stage][1]
+            future = pools[stage].submit(function, items[index])
+            future.add_done_callback(lambda future: advance(index, stage, future))
+
+        def advance(index, stage, future):
+            try:
+                exception = future.exception()
+                if exception is not None:
+                    self.logger.error(f"An error occurred during {self.stages[stage][0]} of {self.describe(items[index])}", exc_info=exception)
+                    finish(index, exception)
+                elif future.result() is False:
+                    finish(index, None)
+                else:
+                    submit(index, stage + 1)
+            except BaseException as e:
+                finish(index, e)
+
+        if len(items) == 0:
+            finished.set()
+        for index in range(len(items)):
+            submit(index, 0)
+
+        try:
+            finished.wait()
+        finally:
+            for pool in pools:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+        return [results.get(index) for index in range(len(items))]
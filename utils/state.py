@@ -0,0 +1,118 @@
+import os
+import sqlite3
+import yaml
+from datetime import datetime
+
+class StateStore:
+    '''
+    Stores the checksums of finished datasets, the status of the processing stages (e.g. download, conversion, compression) and of the BIDS conversion of single subjects in a SQLite database.
+    Every update is a single transaction and the database runs in WAL mode, thus several URT processes can share the same output directory.
+    Checksums from an existing .yaml checksum file are migrated automatically on first use.
+    '''
+    def __init__(self, path, legacy_yaml_path=None, logger=None):
+        self.path = path
+        self.logger = logger
+        connection = self.connect()
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS checksums (name TEXT PRIMARY KEY, checksum TEXT, updated_at TEXT)")
+                connection.execute("CREATE TABLE IF NOT EXISTS stages (dataset TEXT, stage TEXT, status TEXT, updated_at TEXT, PRIMARY KEY (dataset, stage))")
+                connection.execute("CREATE TABLE IF NOT EXISTS subjects (dataset TEXT, subject TEXT, status TEXT, updated_at TEXT, PRIMARY KEY (dataset, subject))")
+                connection.execute("CREATE TABLE IF NOT EXISTS migrations (source TEXT PRIMARY KEY, migrated_at TEXT)")
+        finally:
+            connection.close()
+
+        if legacy_yaml_path is not None and os.path.isfile(legacy_yaml_path):
+            self.migrate_yaml(legacy_yaml_path)
+
+    def connect(self):
+        # isolation_level=None: transactions are started explicitly with BEGIN IMMEDIATE to avoid deadlocks between processes
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def execute(self, query, params=(), write=False):
+        connection = self.connect()
+        try:
+            if not write:
+                return connection.execute(query, params).fetchall()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = connection.execute(query, params).fetchall()
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            return rows
+        finally:
+            connection.close()
+
+    def migrate_yaml(self, yaml_path):
+        source = os.path.abspath(yaml_path)
+        with open(yaml_path, "r") as f:
+            file_hashes = yaml.safe_load(f) or {}
+        file_hashes.pop("placeholder", None)
+
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            if connection.execute("SELECT 1 FROM migrations WHERE source = ?", (source,)).fetchall():
+                connection.execute("COMMIT")
+                return
+            now = datetime.now().isoformat()
+            # Entries written by other processes in the meantime have priority over the old file
+            connection.executemany("INSERT OR IGNORE INTO checksums (name, checksum, updated_at) VALUES (?, ?, ?)", [(name, checksum, now) for name, checksum in file_hashes.items()])
+            connection.execute("INSERT INTO migrations (source, migrated_at) VALUES (?, ?)", (source, now))
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+        if self.logger is not None:
+            self.logger.info(f"Migrated {len(file_hashes)} checksums from \"{yaml_path}\" to \"{self.path}\"")
+
+    def get_checksum(self, name):
+        rows = self.execute("SELECT checksum FROM checksums WHERE name = ?", (name,))
+        return rows[0][0] if rows else None
+
+    def set_checksum(self, name, checksum):
+        self.execute("INSERT OR REPLACE INTO checksums (name, checksum, updated_at) VALUES (?, ?, ?)", (name, checksum, datetime.now().isoformat()), write=True)
+
+    def remove_checksum(self, name):
+        '''
+        Returns the removed checksum or None if there was no checksum for name
+        '''
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            rows = connection.execute("SELECT checksum FROM checksums WHERE name = ?", (name,)).fetchall()
+            connection.execute("DELETE FROM checksums WHERE name = ?", (name,))
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+        return rows[0][0] if rows else None
+
+    def get_stage(self, dataset, stage):
+        rows = self.execute("SELECT status FROM stages WHERE dataset = ? AND stage = ?", (dataset, stage))
+        return rows[0][0] if rows else None
+
+    def set_stage(self, dataset, stage, status):
+        self.execute("INSERT OR REPLACE INTO stages (dataset, stage, status, updated_at) VALUES (?, ?, ?, ?)", (dataset, stage, status, datetime.now().isoformat()), write=True)
+
+    def clear_stages(self, dataset):
+        self.execute("DELETE FROM stages WHERE dataset = ?", (dataset,), write=True)
+
+    def get_subjects(self, dataset, status):
+        rows = self.execute("SELECT subject FROM subjects WHERE dataset = ? AND status = ?", (dataset, status))
+        return set(row[0] for row in rows)
+
+    def set_subjects(self, dataset, subjects, status):
+        now = datetime.now().isoformat()
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany("INSERT OR REPLACE INTO subjects (dataset, subject, status, updated_at) VALUES (?, ?, ?, ?)", [(dataset, subject, status, now) for subject in subjects])
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def clear_subjects(self, dataset):
+        self.execute("DELETE FROM subjects WHERE dataset = ?", (dataset,), write=True)
@@ -6,9 +6,15 @@ from checksumdir import dirhash
 import signal
 import sys
 from threading import Thread
+import threading
+import contextlib
 import re
 import yaml
 import shutil
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.archive import StreamingArchive
 
 def strip_ansi_escape_codes(text):
     # Regular expression to remove ANSI escape codes
@@ -56,25 +62,130 @@ class OutputLogger:
     
     def flush(self): pass
 
-def md5(fname):
+class ThreadOutputRedirect:
+    '''
+    Replacement for sys.stdout or sys.stderr: the output of threads inside redirect_output goes to their target (e.g. an OutputLogger),
+    the output of all other threads to the original stream. Unlike contextlib.redirect_stdout it is safe if several threads redirect their output at the same time.
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.targets = threading.local()
+
+    def target(self):
+        return getattr(self.targets, "target", None) or self.stream
+
+    def write(self, msg):
+        return self.target().write(msg)
+
+    def flush(self):
+        return self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+redirect_lock = threading.Lock()
+
+@contextlib.contextmanager
+def redirect_output(name, target):
+    '''
+    Redirects sys.stdout or sys.stderr (name "stdout" or "stderr") of the current thread to target. Threads started inside the block are not redirected.
+    '''
+    with redirect_lock:
+        stream = getattr(sys, name)
+        if not isinstance(stream, ThreadOutputRedirect):
+            stream = ThreadOutputRedirect(stream)
+            setattr(sys, name, stream)
+    previous = getattr(stream.targets, "target", None)
+    stream.targets.target = target
+    try:
+        yield
+    finally:
+        stream.targets.target = previous
+
+def md5(fname, chunk_size=1024*1024):
         hash_md5 = hashlib.md5()
         with open(fname, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
+            for chunk in iter(lambda: f.read(chunk_size), b""):
                 hash_md5.update(chunk)
         return hash_md5.hexdigest()
 
-def compress(output_file, path, input_directory, logger, remove_files = True):
-    if remove_files:
-        command = f"tar -I pigz -cf {output_file} -C {path} {input_directory} --remove-files"
-    else: 
-         command = f"tar -I pigz -cf {output_file} -C {path} {input_directory}"
-    run_subprocess(command, logger=logger)
+def peak_memory_usage():
+    '''
+    Returns the peak resident memory of the process in MB
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kilobytes on Linux
+    if sys.platform == "darwin":
+        return peak / 1024**2
+    return peak / 1024
+
+def memory_usage():
+    '''
+    Returns the current resident memory of the process in MB, None if it is not available (/proc is missing e.g. on macOS)
+    '''
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+def format_size(num_bytes):
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(num_bytes) < 1024 or unit == "TB":
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+
+def compress(output_file, path, input_directory, logger, remove_files = True, codec="gzip", level=None, threads=None):
+    '''
+    Writes path/input_directory to the archive output_file. With remove_files every file is deleted as soon as it is written to the archive.
+    Returns the md5 hash of the archive, computed while it was written.
+    '''
+    with StreamingArchive(output_file, codec=codec, level=level, threads=threads, logger=logger) as archive:
+        archive.add(os.path.join(path, input_directory), arcname=input_directory, remove=remove_files)
+    return archive.md5
 
 def decompress(input_file, output_directory, logger):
-    command = f"tar -I pigz -xf {input_file} -C {output_directory}"
+    compressor = "zstd" if input_file.endswith(".zst") else "pigz"
+    command = f"tar -I {compressor} -xf \"{input_file}\" -C \"{output_directory}\""
     run_subprocess(command, logger=logger)
 
-def compute_checksum(path):
+def move_folder(source, target, logger, workers=None):
+    '''
+    Moves the folder source to target. Within the same filesystem the folder is renamed, otherwise (or if the rename fails, e.g. on
+    distributed filesystems) the files are copied by several threads and the source is removed afterwards. An existing target folder is merged.
+    '''
+    if not os.path.exists(target) and os.stat(source).st_dev == os.stat(os.path.dirname(os.path.abspath(target))).st_dev:
+        try:
+            os.rename(source, target)
+            logger.debug(f"Renamed {source} to {target}")
+            return
+        except OSError as e:
+            logger.debug(f"Renaming {source} to {target} failed ({e}), copying instead")
+
+    file_pairs = []
+    for root, dirs, files in os.walk(source):
+        target_root = os.path.join(target, os.path.relpath(root, source))
+        os.makedirs(target_root, exist_ok=True)
+        for file in files:
+            file_pairs.append((os.path.join(root, file), os.path.join(target_root, file)))
+
+    # shutil uses copy_file_range/sendfile where available, thus the data is not copied through Python
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda file_pair: shutil.copy2(*file_pair), file_pairs))
+    for root, dirs, files in os.walk(source):
+        shutil.copystat(root, os.path.join(target, os.path.relpath(root, source)))
+    elapsed_time = max(time.time() - start_time, 1e-6)
+
+    total_size = sum(os.path.getsize(target_file) for source_file, target_file in file_pairs)
+    logger.info(f"Copied {len(file_pairs)} files ({format_size(total_size)}) to {target} in {elapsed_time:.1f} s ({format_size(total_size / elapsed_time)}/s)")
+    shutil.rmtree(source)
+
+def compute_checksum(path, manifest=None, deep_verify=False):
+    # The manifest caches the hashes of unchanged files
+    if manifest is not None:
+        return manifest.compute_checksum(path, deep_verify=deep_verify)
     if os.path.isfile(path):
         computed_hash = md5(path)
     else: